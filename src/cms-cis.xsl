@@ -11,6 +11,20 @@
                                 select = "'N'"/>
  <xsl:param                       name = "default.table.width"
                                 select = "''"/>
+ <!-- Hostname suffix for media links (e.g., "-qa"); empty on PROD -->
+ <xsl:param                       name = "mediaTier"
+                                select = "''"/>
+
+ <!-- Index the column specifications of each table group by name -->
+ <xsl:key                         name = "colspec"
+                                 match = "ColSpec"
+                                   use = "concat(generate-id(..), '|',
+                                                 @ColName)"/>
+
+ <!-- Whether the summary has key points at all, tested once per document
+      rather than once per top section -->
+ <xsl:variable                    name = "hasKeyPoints"
+                                select = "boolean(/Summary//KeyPoint)"/>
 
  <xsl:variable                    name = "cdrId"
                                 select = "number(
@@ -119,10 +133,10 @@
    This is also where we're creating the KeyPoints box and the TOC
    =================================================================== -->
             <xsl:for-each       select = "SummarySection">
-              <xsl:variable       name = "topSection">
-                <xsl:text>section_</xsl:text>
-                <xsl:number/>
-              </xsl:variable>
+              <xsl:variable       name = "ordinal"
+                                select = "position()"/>
+              <xsl:variable       name = "topSection"
+                                select = "concat('section_', $ordinal)"/>
               <xsl:element        name = "div">
                <!--OCE Project 3368 - Change <section class="pdq-sections">
                    to <div class="pdq-sections">  -->
@@ -144,13 +158,15 @@
                                            SummaryMetaData/
                                            SummaryToggleURL
                                          and
-                                           position() = 1">
+                                           $ordinal = 1">
                 <xsl:call-template name = "addHpPatientToggle"/>
                </xsl:if>
 
                <xsl:call-template name = "Title_TOC_KP">
                 <xsl:with-param   name = "topSection"
                                 select = "$topSection"/>
+                <xsl:with-param   name = "ordinal"
+                                select = "$ordinal"/>
                </xsl:call-template>
 
               </xsl:element>
@@ -169,6 +185,7 @@
   <xsl:template                   name = "Title_TOC_KP">
     <xsl:param                     name = "topSection"
                                  select = "'toc'"/>
+    <xsl:param                     name = "ordinal"/>
     <!-- The section title of the top SummarySection has to be
         printed above the keypoints box or the TOC -->
     <xsl:apply-templates         select = "Title"/>
@@ -176,8 +193,11 @@
     <!--
    TOC or KeyPoint boxes
    =================================================================== -->
-    <xsl:if                        test = "../descendant::KeyPoint">
-      <xsl:call-template            name = "keypointsbox"/>
+    <xsl:if                        test = "$hasKeyPoints">
+      <xsl:call-template            name = "keypointsbox">
+        <xsl:with-param              name = "ordinal"
+                                   select = "$ordinal"/>
+      </xsl:call-template>
     </xsl:if>
 
     <xsl:apply-templates         select = "*[not(self::Title)]">
@@ -730,11 +750,8 @@
       </xsl:attribute>
       <xsl:apply-templates/>
     </xsl:element>
-    <xsl:if test="following-sibling::node()">
-      <xsl:for-each select="following-sibling::node()">
-        <xsl:if test="name() !='' and position()=1">&#160;</xsl:if>
-      </xsl:for-each>
-    </xsl:if>
+    <!-- Non-breaking space if the next node is an element -->
+    <xsl:if test="name(following-sibling::node()[1]) != ''">&#160;</xsl:if>
   </xsl:template>
 
 
@@ -780,11 +797,8 @@
       </xsl:attribute>
       <xsl:apply-templates/>
     </xsl:element>
-    <xsl:if test="following-sibling::node()">
-      <xsl:for-each select="following-sibling::node()">
-        <xsl:if test="name() !='' and position()=1">&#160;</xsl:if>
-      </xsl:for-each>
-    </xsl:if>
+    <!-- Non-breaking space if the next node is an element -->
+    <xsl:if test="name(following-sibling::node()[1]) != ''">&#160;</xsl:if>
   </xsl:template>
 
 
@@ -801,11 +815,8 @@
       </xsl:attribute>
       <xsl:apply-templates/>
     </xsl:element>
-    <xsl:if test="following-sibling::node()">
-      <xsl:for-each select="following-sibling::node()">
-        <xsl:if test="name() !='' and position()=1">&#160;</xsl:if>
-      </xsl:for-each>
-    </xsl:if>
+    <!-- Non-breaking space if the next node is an element -->
+    <xsl:if test="name(following-sibling::node()[1]) != ''">&#160;</xsl:if>
   </xsl:template>
 
 
@@ -827,11 +838,8 @@
 
       <xsl:apply-templates/>
     </xsl:element>
-    <xsl:if test="following-sibling::node()">
-      <xsl:for-each select="following-sibling::node()">
-        <xsl:if test="name() !='' and position()=1">&#160;</xsl:if>
-      </xsl:for-each>
-    </xsl:if>
+    <!-- Non-breaking space if the next node is an element -->
+    <xsl:if test="name(following-sibling::node()[1]) != ''">&#160;</xsl:if>
   </xsl:template>
 
 
@@ -894,7 +902,8 @@
     <xsl:element name="a">
      <xsl:attribute name="href">
       <!-- Need to set hostname for image URL based on the tier we're on -->
-      <xsl:text>https://nci-media@@MEDIA-TIER@@</xsl:text>
+      <xsl:text>https://nci-media</xsl:text>
+      <xsl:value-of             select = "$mediaTier"/>
       <xsl:text>.cancer.gov</xsl:text>
       <xsl:text>/pdq/media/images/</xsl:text>
       <xsl:value-of             select = "number(
@@ -934,7 +943,8 @@
           <xsl:value-of         select = "@alt"/>
         </xsl:attribute>
         <xsl:attribute            name = "src">
-          <xsl:text>https://nci-media@@MEDIA-TIER@@</xsl:text>
+          <xsl:text>https://nci-media</xsl:text>
+          <xsl:value-of         select = "$mediaTier"/>
           <xsl:text>.cancer.gov</xsl:text>
           <xsl:text>/pdq/media/images/</xsl:text>
           <xsl:value-of         select = "number(
@@ -1020,6 +1030,7 @@
   Template to create the Keypoint box (created with JavaScript)
   ================================================================ -->
   <xsl:template                   name = "keypointsbox">
+    <xsl:param                     name = "ordinal"/>
     <xsl:if                        test = "descendant::KeyPoint">
       <xsl:element                  name = "div">
         <xsl:attribute               name = "class">
@@ -1058,9 +1069,7 @@
             <xsl:text>_kp_section</xsl:text>
             <xsl:value-of            select = "./@id"/>
             <xsl:text>_</xsl:text>
-            <xsl:value-of            select = "count(
-                                            preceding-sibling::SummarySection)
-                                                                         + 1"/>
+            <xsl:value-of            select = "$ordinal"/>
           </xsl:attribute>
 
           <!--
@@ -1434,10 +1443,6 @@ Template for Creating a table (from CALS)
     <xsl:variable                   name = "empty.cell"
                                   select = "count(node()) = 0"/>
 
-   <xsl:variable                  name = "entry.colnum">
-    <xsl:call-template            name = "entry.colnum"/>
-    </xsl:variable>
-
 
     <xsl:element                    name = "{$cellgi}">
 
@@ -1547,115 +1552,32 @@ Template for Creating a table (from CALS)
   </xsl:template>
 
 
-  <!--
-=========================================================================
-========================================================================= -->
-  <xsl:template                     name = "entry.colnum">
-    <xsl:param                      name = "entry"
-                                  select = "."/>
-
-    <xsl:choose>
-      <xsl:when                     test = "$entry/@ColName">
-        <xsl:variable               name = "colname"
-                                  select = "$entry/@ColName"/>
-        <xsl:variable               name = "colspec"
-                                  select = "$entry/ancestor::TGroup
-                                              /ColSpec[@ColName=$colname]"/>
-        <xsl:call-template          name = "colspec.colnum">
-          <xsl:with-param           name = "colspec"
-                                  select = "$colspec"/>
-        </xsl:call-template>
-      </xsl:when>
-      <xsl:when                     test = "$entry/@NameSt">
-        <xsl:variable               name = "namest"
-                                  select = "$entry/@NameSt"/>
-        <xsl:variable               name = "colspec"
-                                  select = "$entry/ancestor::TGroup
-                                              /ColSpec[@ColName=$namest]"/>
-        <xsl:call-template          name = "colspec.colnum">
-          <xsl:with-param           name = "colspec"
-                                  select = "$colspec"/>
-        </xsl:call-template>
-      </xsl:when>
-      <xsl:when                     test = "count($entry/preceding-sibling::*) = 0">1</xsl:when>
-      <xsl:otherwise>
-        <xsl:variable               name = "pcol">
-          <xsl:call-template        name = "entry.ending.colnum">
-            <xsl:with-param         name = "entry"
-                                  select = "$entry/preceding-sibling::*[1]"/>
-          </xsl:call-template>
-        </xsl:variable>
-        <xsl:value-of             select = "$pcol + 1"/>
-      </xsl:otherwise>
-    </xsl:choose>
-  </xsl:template>
-
-
-  <!--
-=========================================================================
-========================================================================= -->
-  <xsl:template                     name = "entry.ending.colnum">
-    <xsl:param                      name = "entry"
-                                  select = "."/>
-
-    <xsl:choose>
-      <xsl:when                     test = "$entry/@ColName">
-        <xsl:variable               name = "colname"
-                                  select = "$entry/@ColName"/>
-        <xsl:variable               name = "colspec"
-                                  select = "$entry/ancestor::TGroup
-                                                /ColSpec[@ColName=$colname]"/>
-        <xsl:call-template          name = "colspec.colnum">
-          <xsl:with-param           name = "colspec"
-                                  select = "$colspec"/>
-        </xsl:call-template>
-      </xsl:when>
-      <xsl:when                     test = "$entry/@NameEnd">
-        <xsl:variable               name = "nameend"
-                                  select = "$entry/@NameEnd"/>
-        <xsl:variable               name = "colspec"
-                                  select = "$entry/ancestor::TGroup
-                                                /ColSpec[@ColName=$nameend]"/>
-        <xsl:call-template          name = "colspec.colnum">
-          <xsl:with-param           name = "colspec"
-                                  select = "$colspec"/>
-        </xsl:call-template>
-      </xsl:when>
-      <xsl:when                     test = "count($entry/preceding-sibling::*) = 0">1</xsl:when>
-      <xsl:otherwise>
-        <xsl:variable               name = "pcol">
-          <xsl:call-template        name = "entry.ending.colnum">
-            <xsl:with-param         name = "entry"
-                                  select = "$entry/preceding-sibling::*[1]"/>
-          </xsl:call-template>
-        </xsl:variable>
-        <xsl:value-of             select = "$pcol + 1"/>
-      </xsl:otherwise>
-    </xsl:choose>
-  </xsl:template>
-
-
   <!--
 =========================================================================
 ========================================================================= -->
   <xsl:template                     name = "colspec.colnum">
     <xsl:param                      name = "colspec"
                                   select = "."/>
+    <!-- Count forward from the nearest ColSpec with an explicit number
+         instead of recursing back through each preceding ColSpec -->
+    <xsl:variable                   name = "numbered"
+                                  select = "$colspec/preceding-sibling
+                                              ::ColSpec[@ColNum][1]"/>
     <xsl:choose>
       <xsl:when                     test = "$colspec/@ColNum">
         <xsl:value-of             select = "$colspec/@ColNum"/>
       </xsl:when>
-      <xsl:when                     test = "$colspec/preceding-sibling::ColSpec">
-        <xsl:variable               name = "prec.colspec.colnum">
-          <xsl:call-template        name = "colspec.colnum">
-            <xsl:with-param         name = "colspec"
-                                  select = "$colspec
-                                           /preceding-sibling::ColSpec[1]"/>
-          </xsl:call-template>
-        </xsl:variable>
-        <xsl:value-of             select = "$prec.colspec.colnum + 1"/>
+      <xsl:when                     test = "$numbered">
+        <xsl:value-of             select = "$numbered/@ColNum
+                                            + count($colspec/preceding-sibling
+                                                    ::ColSpec)
+                                            - count($numbered/preceding-sibling
+                                                    ::ColSpec)"/>
       </xsl:when>
-      <xsl:otherwise>1</xsl:otherwise>
+      <xsl:otherwise>
+        <xsl:value-of             select = "count($colspec/preceding-sibling
+                                                  ::ColSpec) + 1"/>
+      </xsl:otherwise>
     </xsl:choose>
   </xsl:template>
 
@@ -1805,6 +1727,9 @@ Template for Creating a table (from CALS)
   <xsl:template                     name = "calculate.colspan">
     <xsl:param                       name = "entry"
                                    select = "."/>
+    <xsl:variable                    name = "tgroup"
+                                   select = "generate-id($entry
+                                                /ancestor::TGroup[1])"/>
     <xsl:variable                    name = "namest"
                                    select = "$entry/@NameSt"/>
     <xsl:variable                    name = "nameend"
@@ -1813,15 +1738,17 @@ Template for Creating a table (from CALS)
     <xsl:variable                    name = "scol">
       <xsl:call-template            name = "colspec.colnum">
         <xsl:with-param             name = "colspec"
-                                  select = "$entry/ancestor::TGroup
-                                                /ColSpec[@ColName=$namest]"/>
+                                  select = "key('colspec',
+                                                concat($tgroup, '|',
+                                                       $namest))"/>
       </xsl:call-template>
     </xsl:variable>
     <xsl:variable                   name = "ecol">
       <xsl:call-template            name = "colspec.colnum">
         <xsl:with-param             name = "colspec"
-                                  select = "$entry/ancestor::TGroup
-                                                /ColSpec[@ColName=$nameend]"/>
+                                  select = "key('colspec',
+                                                concat($tgroup, '|',
+                                                       $nameend))"/>
       </xsl:call-template>
     </xsl:variable>
     <xsl:value-of                  select = "$ecol - $scol + 1"/>
@@ -348,11 +348,8 @@
       </xsl:attribute>
       <xsl:apply-templates/>
     </xsl:element>
-    <xsl:if test="following-sibling::node()">
-      <xsl:for-each select="following-sibling::node()">
-        <xsl:if test="name() !='' and position()=1">&#160;</xsl:if>
-      </xsl:for-each>
-    </xsl:if>
+    <!-- Non-breaking space if the next node is an element -->
+    <xsl:if test="name(following-sibling::node()[1]) != ''">&#160;</xsl:if>
   </xsl:template>
 
   <!--
@@ -4,20 +4,36 @@
 Push summary documents to a Drupal CMS server.
 """
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 from copy import deepcopy
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from functools import cached_property
+from hashlib import sha256
 from json import dumps as json_dumps, loads as json_loads
 from logging import basicConfig, getLogger
-from os import chdir, getenv
+from os import chdir, cpu_count, getenv, sysconf, utime
 from pathlib import Path
-from re import compile as re_compile, sub as re_sub
-from time import sleep
+from queue import Full, Queue
+from random import uniform
+from re import compile as re_compile, split as re_split, sub as re_sub
+from subprocess import run as run_command
+from sys import stdin
+from tempfile import TemporaryDirectory
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter, sleep
 from urllib.parse import urlparse
 from lxml import etree, html
 from lxml.html import builder as B
-from requests import get, patch, post
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LOADED = perf_counter()
 
 
 class Control:
@@ -26,29 +42,209 @@ class Control:
     FMT = "%(asctime)s [%(levelname)s] %(message)s"
     LOG = "publish.log"
     BASE = "http://www.devbox"
+    CACHE = Path("../cache")
+    PUBLISHED = CACHE / "published.json"
+    SOFTWARE = {
+        "src/cms-cis.xsl": {"cis"},
+        "src/cms-dis.xsl": {"dis"},
+        "src/cms-templates.xsl": {"cis", "dis"},
+        "src/publish.py": {"cis", "dis"},
+    }
+    WINDOW = 4
+    SPOOL = Path("/dev/shm")
+    QUEUE_SIZE = 8
+    STARTUP_BUDGET = 0.5
+    CDR_ID = re_compile(r"(?i)^(CDR)?\d+(#.*)?$")
+
+    def __init__(self):
+        """Work from the directory where the script and stylesheets live"""
+        chdir(Path(__file__).resolve().parent)
 
     def run(self):
         """Top-level entry point for the script"""
 
         start = datetime.now()
-        pushed = []
-        for doc in self.docs:
+        if self.opts.forget:
+            self.client.forget()
+            return
+        publisher = None
+        documents = self.stage()
+        scheduler = Scheduler(self)
+        if not self.dump_dir:
+            connections = self.concurrency
+            if self.opts.compare:
+                connections += self.client.COMPARE_THREADS
+                documents = self.client.changed(documents, scheduler)
+            self.client.warm_up(connections)
+            if not self.opts.compare:
+                self.client.prefetch(self.docs)
+            publisher = Publisher(self)
+        startup = self.__uptime()
+        args = startup, self.STARTUP_BUDGET
+        message = "startup took %.3f seconds (budget %.3f seconds)"
+        if startup > self.STARTUP_BUDGET:
+            message += " OVER BUDGET"
+        self.logger.debug(message, *args)
+        failed = {}
+        try:
             if self.dump_dir:
-                doc.dump()
+                for doc, payload in documents:
+                    doc.dump(payload)
+            elif self.concurrency > 1:
+                args = documents, scheduler, publisher
+                failed = self.__push_concurrently(*args)
             else:
-                nid = self.client.push(doc.values)
-                pushed.append((doc.id, nid, doc.langcode))
+                ready = deque()
+
+                def push_ready():
+                    while ready:
+                        doc, payload = ready.popleft()
+                        nid = self.client.push(doc, payload)
+                        if nid is not None:
+                            publisher.add(doc.id, nid, doc.langcode)
+                        ready.extend(scheduler.finished(doc.id))
+
+                for doc, payload in documents:
+                    ready.extend(scheduler.add(doc, payload))
+                    push_ready()
+                ready.extend(scheduler.drain())
+                push_ready()
+        finally:
+            if publisher is not None:
+                self.client.cancel_lookups()
+                publisher.stop()
         if not self.dump_dir:
-            errors = self.client.publish(pushed)
+            if self.client.skipped:
+                message = "%d unchanged summaries were not pushed"
+                self.logger.info(message, self.client.skipped)
+            errors = publisher.finish()
+            self.client.report()
             if errors:
                 msg = f"{len(errors)} Drupal publish errors; see logs"
                 raise Exception(msg)
+            if failed:
+                ids = ", ".join(f"CDR{cdr_id}" for cdr_id in sorted(failed))
+                self.logger.error("summaries not pushed: %s", ids)
+                raise Exception(f"{len(failed)} push failures; see logs")
+            try:
+                self.__record_commit()
+            except Exception as e:
+                message = "commit not recorded for --changed-since last: %s"
+                self.logger.warning(message, e)
         else:
             print(f"dumped {len(self.docs)} summaries to {self.dump_dir}")
+        self.cache.report()
         elapsed = datetime.now() - start
         verb = "Dumped" if self.dump_dir else "Sent"
         self.logger.info("%s %d docs in %s", verb, len(self.docs), elapsed)
 
+    def render(self):
+        """Generate the CMS values for each summary, in `docs` order
+
+        With more than one job, the XSLT work is spread across a pool of
+        worker processes, each of which compiles the stylesheets once.
+        Only a bounded number of documents (`WINDOW` per job) are allowed
+        to get ahead of the caller, and results are always handed back
+        in the original order, so dumps and pushes stay deterministic.
+        Workers don't send the rendered values back through the pool's
+        pipe. Each one writes the encoded payload to a file (the render
+        cache entry, or a file in a spool directory kept in memory when
+        `SPOOL` is available) and returns only a small descriptor.
+
+        Yield:
+          tuple of Summary object and its encoded CMS values
+        """
+
+        if self.jobs < 2 or len(self.docs) < 2:
+            for doc in self.docs:
+                payload = self.cache.get(doc)
+                if payload is None:
+                    payload = doc.payload
+                    self.cache.put(doc, payload)
+                yield doc, payload
+            return
+        self.logger.info("rendering with %d processes", self.jobs)
+        opts = dict(initializer=start_renderer, initargs=(self.opts,))
+        pool = ProcessPoolExecutor(self.jobs, **opts)
+        spool = self.SPOOL if self.SPOOL.is_dir() else None
+        spool = TemporaryDirectory(prefix="pdq-spool-", dir=spool)
+        pending = deque()
+        try:
+            for doc in self.docs:
+                payload = self.cache.get(doc)
+                if payload is None:
+                    target = self.cache.target(doc)
+                    cached = target is not None
+                    if not cached:
+                        target = Path(spool.name) / f"{doc.id}.json"
+                    args = type(doc), doc.path, target
+                    future = pool.submit(render_summary, *args)
+                else:
+                    future = Future()
+                    future.set_result(payload)
+                    cached = False
+                pending.append((doc, future, cached))
+                if len(pending) >= self.jobs * self.WINDOW:
+                    yield self.__collect(*pending.popleft())
+            while pending:
+                yield self.__collect(*pending.popleft())
+        finally:
+            pool.shutdown(cancel_futures=True)
+            spool.cleanup()
+
+    def stage(self):
+        """Generate rendered summaries from a separate rendering stage
+
+        A background thread drives `render()` and feeds a bounded queue,
+        so the XSLT work for upcoming documents overlaps with our waits
+        on the CMS for the current one. When the queue holds `QUEUE_SIZE`
+        documents the renderer blocks until we catch up, which keeps
+        memory usage bounded.
+
+        Yield:
+          tuple of Summary object and its encoded CMS values
+        """
+
+        queue = Queue(self.QUEUE_SIZE)
+        stop = Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def renderer():
+            items = self.render()
+            try:
+                for item in items:
+                    if not put(item):
+                        return
+                put(None)
+            except BaseException as e:
+                put(e)
+            finally:
+                items.close()
+
+        if not self.docs:
+            return
+        thread = Thread(target=renderer, name="renderer", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
     @cached_property
     def auth(self):
         """Credentials for the CMS"""
@@ -59,38 +255,88 @@ class Control:
 
     @cached_property
     def catalog(self):
-        """Dictionary of all available summaries, indexed by CDR ID"""
+        """Index of all available summaries, by CDR ID"""
+        return Catalog(self)
 
-        catalog = {}
-        root = Path("../docs")
-        for type in ("cis", "dis"):
-            cls = CIS if type == "cis" else DIS
-            for langcode in ("en", "es"):
-                for path in root.glob(f"{type}/{langcode}/*.xml"):
-                    id = int(path.stem)
-                    catalog[id] = cls(self, path)
-        return catalog
+    @cached_property
+    def cache(self):
+        """Rendered values saved from earlier runs"""
+        return RenderCache(self)
+
+    @cached_property
+    def changes(self):
+        """What has changed since the commit named by `--changed-since`
+
+        A change to one of the stylesheets or to this script means every
+        summary of the affected type(s) must be published again.
+
+        Return:
+          None if every summary is a candidate for publishing, otherwise
+          a tuple of the set of IDs for summaries whose documents have
+          changed and the set of types for which everything is needed
+        """
+
+        since = self.opts.changed_since
+        if not since:
+            return None
+        if since == "last":
+            published = {}
+            if self.PUBLISHED.exists():
+                published = json_loads(self.PUBLISHED.read_text())
+            since = published.get(self.opts.base)
+            if not since:
+                message = "no commit recorded for %s; publishing everything"
+                self.logger.warning(message, self.opts.base)
+                return None
+        ids, types = set(), set()
+        args = "diff", "--name-only", "--no-renames", since, self.commit
+        for name in self.git(*args, "--").splitlines():
+            if name in self.SOFTWARE:
+                types |= self.SOFTWARE[name]
+            elif name.startswith("docs/") and name.endswith(".xml"):
+                ids.add(int(Path(name).stem))
+        self.logger.info("%d documents changed since %s", len(ids), since)
+        if types:
+            self.logger.info("software changed for %s", sorted(types))
+        return ids, types
 
     @cached_property
     def client(self):
         """What we use to talk to the Drupal CMS"""
         return DrupalClient(self)
 
+    @cached_property
+    def commit(self):
+        """Hash for the git commit checked out for this job"""
+        return self.git("rev-parse", "HEAD").strip()
+
+    @cached_property
+    def concurrency(self):
+        """Number of summaries to push to the CMS at the same time"""
+        concurrency = self.opts.concurrency
+        if concurrency < 1:
+            raise Exception("concurrency cannot be less than 1")
+        return concurrency
+
     @cached_property
     def docs(self):
         """Sequence of CIS and/or DIS objects"""
 
-        if self.opts.ids:
+        # Summaries named by ID must still pass the other filters.
+        if self.ids:
             docs = []
-            for doc_id in self.opts.ids:
-                if doc_id not in self.catalog:
+            for doc_id in self.ids:
+                entry = self.catalog.entry(doc_id)
+                if entry is None:
                     raise Exception(f"CDR{doc_id} not found")
-                docs.append(self.catalog[doc_id])
+                if self.__selected(entry):
+                    docs.append(self.catalog.summary(entry))
+            if len(docs) < len(self.ids):
+                args = len(docs), len(self.ids)
+                message = "%d of %d requested summaries selected"
+                self.logger.info(message, *args)
             return sorted(docs)
-        docs = self.catalog.values()
-        if self.opts.type:
-            docs = [d for d in docs if d.TYPE == self.opts.type]
-        docs = sorted(docs)
+        docs = sorted(self.catalog.query(self.__selected))
         if self.opts.max is not None or self.opts.skip is not None:
             start = self.opts.skip or 0
             if start < 0:
@@ -118,6 +364,32 @@ class Control:
         path.mkdir(parents=True)
         return path
 
+    @cached_property
+    def ids(self):
+        """CDR IDs for specific summaries requested by the user"""
+
+        ids = list(self.opts.ids or [])
+        if self.opts.ids_from:
+            if self.opts.ids_from == "-":
+                text = stdin.read()
+            else:
+                text = Path(self.opts.ids_from).read_text()
+            for token in re_split(r"[\s,]+", text):
+                if token:
+                    if not self.CDR_ID.match(token):
+                        error = f"--ids-from: {token!r} is not a CDR ID"
+                        raise Exception(error)
+                    ids.append(Summary.extract_id(token))
+        return ids
+
+    @cached_property
+    def jobs(self):
+        """Number of processes to use for rendering the summaries"""
+        jobs = self.opts.jobs or cpu_count() or 1
+        if jobs < 1:
+            raise Exception("jobs cannot be less than 1")
+        return jobs
+
     @cached_property
     def logger(self):
         """Used for recording what we do."""
@@ -131,27 +403,275 @@ class Control:
         """Processing options."""
 
         types = "cis", "dis"
+        languages = "en", "es"
+        audience_help = "restrict push to summaries for one audience"
         base_help = "base URL for CMS (default: http://www.devbox)"
         batch_help = "number to mark as publishable in each call"
+        changed_help = "only push summaries changed since commit (or 'last')"
+        compare_help = "only push summaries which differ from the CMS copy"
+        concurrency_help = "number of summaries to push at once (default: 1)"
+        connections_help = "most connections to keep open to the CMS"
         debug_help = "enable debug logging"
         dump_help = "store summary JSON locally instead of pushing it"
+        force_help = "push summaries even if unchanged since the last push"
+        forget_help = "discard the record of what was pushed to --base"
         ids_help = "push specific summaries"
+        ids_from_help = "push summaries whose IDs are in FILE ('-' for stdin)"
+        jobs_help = "number of rendering processes (default: CPU count)"
+        language_help = "restrict push to summaries in a single language"
         max_help = "maximum number of summaries to push"
+        max_size_help = "skip summary documents larger than this many bytes"
+        min_size_help = "skip summary documents smaller than this many bytes"
+        modified_help = "restrict push to summaries modified since YYYY-MM-DD"
+        no_cache_help = "render every summary instead of using the cache"
         skip_help = "number of summaries to skip past"
+        stream_help = "send each summary to the CMS in chunks"
+        summary_type_help = "restrict push to summaries of one summary type"
         tier_help = "where to link for media on Akamai"
         type_help = "restrict push to single summary type"
         parser = ArgumentParser()
+        parser.add_argument("--audience", help=audience_help)
         parser.add_argument("--base", default=self.BASE, help=base_help)
         parser.add_argument("--batch", type=int, help=batch_help)
+        parser.add_argument("--changed-since", metavar="REF",
+                            help=changed_help)
+        parser.add_argument("--compare", action="store_true",
+                            help=compare_help)
+        parser.add_argument("--concurrency", type=int, default=1,
+                            metavar="N", help=concurrency_help)
+        parser.add_argument("--connections", type=int, metavar="N",
+                            help=connections_help)
         parser.add_argument("--debug", action="store_true", help=debug_help)
         parser.add_argument("--dump", action="store_true", help=dump_help)
+        parser.add_argument("--force", action="store_true", help=force_help)
+        parser.add_argument("--forget", action="store_true", help=forget_help)
         parser.add_argument("--ids", type=int, nargs="+", help=ids_help)
+        parser.add_argument("--ids-from", metavar="FILE", help=ids_from_help)
+        parser.add_argument("--jobs", type=int, help=jobs_help)
+        parser.add_argument("--language", choices=languages,
+                            help=language_help)
         parser.add_argument("--max", type=int, help=max_help)
+        parser.add_argument("--max-size", type=int, help=max_size_help)
+        parser.add_argument("--min-size", type=int, help=min_size_help)
+        parser.add_argument("--modified-since", metavar="DATE",
+                            type=self.__date, help=modified_help)
+        parser.add_argument("--no-cache", action="store_true",
+                            help=no_cache_help)
         parser.add_argument("--skip", type=int, help=skip_help)
+        parser.add_argument("--stream", action="store_true",
+                            help=stream_help)
+        parser.add_argument("--summary-type", help=summary_type_help)
         parser.add_argument("--tier", default="PROD", help=tier_help)
         parser.add_argument("--type", choices=types, help=type_help)
         return parser.parse_args()
 
+    def __collect(self, doc, future, cached):
+        """Wait for a summary's values, picking up newly rendered ones
+
+        Pass:
+          doc - Summary object whose values are being collected
+          future - where the values (or their descriptor) will show up
+          cached - True if a worker is writing a new render cache entry
+
+        Return:
+          tuple of Summary object and its encoded CMS values
+        """
+
+        result = future.result()
+        if isinstance(result, Payload):
+            return doc, result
+        path, size, digest = result
+        payload = Payload(path.read_bytes())
+        payload.digest = digest
+        if cached:
+            self.cache.stored(size)
+        else:
+            path.unlink()
+        return doc, payload
+
+    def __push_concurrently(self, documents, scheduler, publisher):
+        """Push summaries from a pool of `concurrency` threads
+
+        No more than `concurrency` pushes are in flight at once; until
+        one of them finishes we stop taking rendered documents, so the
+        rendering stage is held back as well. Spanish summaries still
+        wait for their English originals (see `Scheduler`). A failed
+        push is logged and recorded, and the other pushes carry on.
+
+        Pass:
+          documents - iterable sequence of (Summary, Payload) tuples
+          scheduler - decides when each summary can be pushed
+          publisher - sweeps the pushed summaries to the published state
+
+        Return:
+          dictionary of error messages for failed pushes, by CDR ID
+        """
+
+        failed = {}
+        ready = deque()
+        in_flight = {}
+        opts = dict(thread_name_prefix="push")
+        with ThreadPoolExecutor(self.concurrency, **opts) as pool:
+
+            def submit_ready():
+                while ready and len(in_flight) < self.concurrency:
+                    doc, payload = ready.popleft()
+                    future = pool.submit(self.client.push, doc, payload)
+                    in_flight[future] = doc
+
+            def settle():
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    doc = in_flight.pop(future)
+                    try:
+                        nid = future.result()
+                        if nid is not None:
+                            publisher.add(doc.id, nid, doc.langcode)
+                    except Exception as e:
+                        args = doc.id, e
+                        self.logger.error("CDR%d: push failed: %s", *args)
+                        failed[doc.id] = str(e)
+                    ready.extend(scheduler.finished(doc.id))
+                submit_ready()
+
+            for doc, payload in documents:
+                ready.extend(scheduler.add(doc, payload))
+                submit_ready()
+                while len(in_flight) >= self.concurrency:
+                    settle()
+            ready.extend(scheduler.drain())
+            submit_ready()
+            while in_flight:
+                settle()
+        return failed
+
+    def __selected(self, entry):
+        """Find out whether a summary passes the user's selection filters
+
+        Pass:
+          entry - the summary's metadata from the catalog index
+
+        Return:
+          True if the summary should be processed
+        """
+
+        opts = self.opts
+        if opts.type and entry["type"] != opts.type:
+            return False
+        if opts.language and entry["language"] != opts.language:
+            return False
+        if opts.audience:
+            audience = (entry["audience"] or "").lower()
+            if audience != opts.audience.lower():
+                return False
+        if opts.summary_type:
+            summary_type = (entry["summary_type"] or "").lower()
+            if summary_type != opts.summary_type.lower():
+                return False
+        if opts.modified_since:
+            if (entry["updated"] or "")[:10] < opts.modified_since:
+                return False
+        if opts.min_size is not None and entry["size"] < opts.min_size:
+            return False
+        if opts.max_size is not None and entry["size"] > opts.max_size:
+            return False
+        if self.changes is not None:
+            ids, types = self.changes
+            if entry["type"] not in types and entry["id"] not in ids:
+                return False
+        return True
+
+    def __record_commit(self):
+        """Remember the commit we published for `--changed-since last`
+
+        Only a job which pushed everything selected by the full set of
+        summaries (or by the changes since the last such job) qualifies,
+        so a job narrowed by any of the selection options doesn't.
+        Failures (for example, running from a tree which isn't a git
+        checkout) are left to the caller, which only logs them, as the
+        job itself has succeeded by then.
+        """
+
+        opts = self.opts
+        if self.ids or opts.skip or opts.max is not None:
+            return
+        filters = (
+            opts.type,
+            opts.language,
+            opts.audience,
+            opts.summary_type,
+            opts.modified_since,
+            opts.min_size,
+            opts.max_size,
+        )
+        if any(value is not None for value in filters):
+            return
+        published = {}
+        if self.PUBLISHED.exists():
+            published = json_loads(self.PUBLISHED.read_text())
+
+        # Changes since an arbitrary commit only cover everything since
+        # the recorded commit if they reach back at least that far.
+        since = opts.changed_since
+        if since and since != "last":
+            recorded = published.get(opts.base)
+            covered = False
+            if recorded:
+                args = "merge-base", "--is-ancestor", since, recorded
+                command = ["git", *args]
+                result = run_command(command, capture_output=True)
+                covered = not result.returncode
+            if not covered:
+                message = "changes since %s miss some for %s; not recorded"
+                self.logger.info(message, since, opts.base)
+                return
+        published[opts.base] = self.commit
+        self.PUBLISHED.parent.mkdir(parents=True, exist_ok=True)
+        self.PUBLISHED.write_text(json_dumps(published, indent=2))
+        self.logger.info("recorded commit %s for %s", self.commit, opts.base)
+
+    @staticmethod
+    def __date(value):
+        """Validate a date given on the command line"""
+
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise ArgumentTypeError(f"invalid date {value!r}")
+
+    @staticmethod
+    def __uptime():
+        """How long the process has been running, in seconds
+
+        On Linux the process start time comes from /proc, so the
+        interpreter's own startup and the imports are counted. Elsewhere
+        we can only count from the point where the imports finished.
+        """
+
+        try:
+            stat = Path("/proc/self/stat").read_text()
+            ticks = int(stat.rsplit(")", 1)[1].split()[19])
+            uptime = float(Path("/proc/uptime").read_text().split()[0])
+            return uptime - ticks / sysconf("SC_CLK_TCK")
+        except Exception:
+            return perf_counter() - LOADED
+
+    @staticmethod
+    def git(*args):
+        """Run a git command and return what it writes to stdout
+
+        Pass:
+          args - git subcommand and its arguments
+
+        Return:
+          string for the command's output
+        """
+
+        result = run_command(["git", *args], capture_output=True, text=True)
+        if result.returncode:
+            raise Exception(f"git {args[0]}: {result.stderr.strip()}")
+        return result.stdout
+
     @staticmethod
     def get_secret(name, fallback=Path(".secrets.json")):
         """Retrieve a sensitive value
@@ -175,11 +695,795 @@ class Control:
         return None
 
 
+class Catalog:
+    """Persistent index of the summary documents in the repository
+
+    For each document we record its ID, type, language, location, size,
+    and modification time, along with the metadata we need for selecting
+    and scheduling summaries without parsing them. An entry is refreshed
+    when the size or modification time of its document changes, and a
+    directory is only listed again when its own modification time shows
+    that documents have been added or removed. Lookups by ID go straight
+    to the index, without walking any directories.
+    """
+
+    VERSION = 2
+    ROOT = Path("../docs")
+    PATH = Control.CACHE / "catalog.json"
+    DIRECTORIES = "cis/en", "cis/es", "dis/en", "dis/es"
+    TAIL_SIZE = 16 * 1024
+    TAGS = {
+        "cis": dict(
+            title="SummaryTitle",
+            meta="SummaryMetaData",
+            section="SummarySection",
+        ),
+        "dis": dict(
+            title="DrugInfoTitle",
+            meta="DrugInfoMetaData",
+            section="Section",
+        ),
+    }
+    META = {
+        "cis": dict(
+            audience="SummaryAudience",
+            summary_type="SummaryType",
+            url="SummaryURL",
+        ),
+        "dis": dict(
+            audience="DrugInfoAudience",
+            summary_type="DrugInfoType",
+            url="DrugInfoURL",
+        ),
+    }
+
+    def __init__(self, control):
+        """Remember the caller
+
+        Required positional argument:
+          control - provides access to processing information
+        """
+
+        self.control = control
+        self.summaries = {}
+        self.dirty = False
+
+    def __contains__(self, cdr_id):
+        """True if the repository has the summary document"""
+        return self.entry(cdr_id) is not None
+
+    def __getitem__(self, cdr_id):
+        """Get the `CIS` or `DIS` object for a summary document"""
+
+        entry = self.entry(cdr_id)
+        if entry is None:
+            raise KeyError(cdr_id)
+        return self.summary(entry)
+
+    @cached_property
+    def entries(self):
+        """Dictionary of index entries, by CDR ID"""
+        return self.index["entries"]
+
+    @cached_property
+    def index(self):
+        """What we know about the documents, loaded from the last run"""
+
+        try:
+            index = json_loads(self.PATH.read_text())
+            if index.get("version") == self.VERSION:
+                entries = index["entries"].items()
+                index["entries"] = {int(k): v for k, v in entries}
+                return index
+        except FileNotFoundError:
+            pass
+        self.logger.info("building catalog index")
+        return dict(version=self.VERSION, directories={}, entries={})
+
+    @cached_property
+    def logger(self):
+        """Object for recording what we do"""
+        return self.control.logger
+
+    def entry(self, cdr_id):
+        """Find the index entry for a single document
+
+        Pass:
+          cdr_id - integer for the summary document
+
+        Return:
+          dictionary of indexed values or None if not found
+        """
+
+        entry = self.entries.get(cdr_id)
+        if entry is not None:
+            entry = self.__check(Path(entry["path"]), entry)
+        else:
+            for directory in self.DIRECTORIES:
+                path = self.ROOT / directory / f"{cdr_id}.xml"
+                entry = self.__check(path)
+                if entry is not None:
+                    break
+        self.save()
+        return entry
+
+    def query(self, test):
+        """Find the summaries whose index entries pass a test
+
+        Pass:
+          test - callable which takes an index entry and returns a bool
+
+        Return:
+          list of `CIS` and `DIS` objects for the selected documents
+        """
+
+        self.refresh()
+        entries = self.entries.values()
+        return [self.summary(entry) for entry in entries if test(entry)]
+
+    def refresh(self):
+        """Bring the index up to date with the documents on disk"""
+
+        directories = self.index["directories"]
+        for name in self.DIRECTORIES:
+            type, langcode = name.split("/")
+            indexed = {}
+            for entry in self.entries.values():
+                if entry["type"] == type and entry["language"] == langcode:
+                    indexed[entry["id"]] = entry
+            directory = self.ROOT / name
+            try:
+                mtime = directory.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime is not None and directories.get(name) == mtime:
+                for entry in indexed.values():
+                    self.__check(Path(entry["path"]), entry)
+                continue
+            paths = {}
+            if mtime is not None:
+                paths = {int(p.stem): p for p in directory.glob("*.xml")}
+            for cdr_id in indexed.keys() - paths.keys():
+                del self.entries[cdr_id]
+            for cdr_id, path in paths.items():
+                self.__check(path, indexed.get(cdr_id))
+            directories[name] = mtime
+            self.dirty = True
+        self.save()
+
+    def save(self):
+        """Write the index to disk if it has changed"""
+
+        if self.dirty:
+            self.PATH.parent.mkdir(parents=True, exist_ok=True)
+            temp = self.PATH.with_suffix(".tmp")
+            temp.write_text(json_dumps(self.index))
+            temp.replace(self.PATH)
+            self.dirty = False
+
+    def scan(self, path, stat):
+        """Collect the index values for a summary document
+
+        Everything we index comes either before the first summary
+        section (the title and the metadata) or after the last one
+        (TranslationOf and DateLastModified), and the sections make up
+        nearly all of the document. So we parse the front of the file
+        only until the first top-level section starts, and then parse
+        just the bytes which follow the last section's closing tag. If
+        the end of the document can't be handled that way, we fall back
+        on parsing the whole thing.
+
+        Pass:
+          path - location of the document
+          stat - results of the `stat()` call for the document
+
+        Return:
+          dictionary of values for the document's index entry
+        """
+
+        type, langcode = path.parts[-3], path.parts[-2]
+        names = self.TAGS[type]
+        entry = dict(
+            id=int(path.stem),
+            type=type,
+            language=langcode,
+            path=str(path),
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            translation_of=None,
+            url=None,
+            title=None,
+            audience=None,
+            summary_type=None,
+            updated=None,
+        )
+        with path.open("rb") as fp:
+            tags = set(names.values())
+            events = etree.iterparse(fp, ("start", "end"), tag=tags)
+            for event, node in events:
+                if node.getparent().getparent() is not None:
+                    continue
+                if node.tag == names["section"]:
+                    break
+                if event == "end":
+                    self.__index(type, node, entry)
+            trailing = self.__tail(fp, names["section"])
+        if trailing is None:
+            tags = "TranslationOf", "DateLastModified"
+            for event, node in etree.iterparse(str(path), tag=tags):
+                if node.getparent().getparent() is None:
+                    self.__index(type, node, entry)
+        else:
+            for node in trailing:
+                self.__index(type, node, entry)
+        return entry
+
+    def summary(self, entry):
+        """Get the `CIS` or `DIS` object for an index entry"""
+
+        cdr_id = entry["id"]
+        if cdr_id not in self.summaries:
+            cls = CIS if entry["type"] == "cis" else DIS
+            self.summaries[cdr_id] = cls(self.control, Path(entry["path"]))
+        return self.summaries[cdr_id]
+
+    def __check(self, path, entry=None):
+        """Make sure an index entry reflects what is on disk
+
+        Pass:
+          path - location of the document
+          entry - what we have in the index for the document, if anything
+
+        Return:
+          possibly refreshed index entry, or None if the document is gone
+        """
+
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            if entry is not None:
+                del self.entries[entry["id"]]
+                self.dirty = True
+            return None
+        if entry is not None:
+            if entry["size"] == stat.st_size:
+                if entry["mtime"] == stat.st_mtime_ns:
+                    return entry
+        entry = self.entries[int(path.stem)] = self.scan(path, stat)
+        self.dirty = True
+        return entry
+
+    def __index(self, type, node, entry):
+        """Copy what we index from one of a document's top-level elements
+
+        Pass:
+          type - "cis" or "dis"
+          node - top-level element of the document
+          entry - dictionary of index values, updated in place
+        """
+
+        names = self.TAGS[type]
+        if node.tag == names["title"]:
+            entry["title"] = Summary.get_text(node)
+        elif node.tag == names["meta"]:
+            for name, tag in self.META[type].items():
+                child = node.find(tag)
+                if child is None:
+                    continue
+                if name == "url":
+                    entry[name] = child.get("xref")
+                else:
+                    entry[name] = Summary.get_text(child)
+        elif node.tag == "TranslationOf":
+            entry["translation_of"] = Summary.extract_id(node.get("ref"))
+        elif node.tag == "DateLastModified":
+            entry["updated"] = Summary.get_text(node)
+
+    def __tail(self, fp, section):
+        """Parse the top-level elements following a document's sections
+
+        Pass:
+          fp - document file opened for reading bytes
+          section - tag name for the summary sections
+
+        Return:
+          element whose children are the top-level elements after the
+          last section, or None if they can't be found that way
+        """
+
+        size = fp.seek(0, 2)
+        fp.seek(max(0, size - self.TAIL_SIZE))
+        tail = fp.read()
+        close = f"</{section}>".encode()
+        start = tail.rfind(close)
+        end = tail.rfind(b"</")
+        if start < 0 or end <= start:
+            return None
+        try:
+            body = tail[start+len(close):end]
+            return etree.fromstring(b"<tail>" + body + b"</tail>")
+        except etree.XMLSyntaxError:
+            return None
+
+
+class Scheduler:
+    """Decide when each rendered document can be pushed to the CMS
+
+    The English summary must be stored in the CMS before its Spanish
+    translation can be pushed (business rule confirmed by Bryan
+    Pizillo). Using the catalog index, we find the Spanish summaries
+    whose English originals are part of the same job, and hold each of
+    them back until the English summary has been pushed, releasing
+    everything else as soon as it arrives. Translations of summaries
+    which are not part of the job are not held, as their originals
+    must already be in the CMS.
+    """
+
+    def __init__(self, control):
+        """Build the dependency graph for the job's documents
+
+        Required positional argument:
+          control - provides access to processing information
+        """
+
+        self.control = control
+        self.done = set()
+        self.waiting = {}
+        self.originals = {}
+        selected = {doc.id for doc in control.docs}
+        for cdr_id in selected:
+            entry = control.catalog.entries.get(cdr_id) or {}
+            original = entry.get("translation_of")
+            if original in selected:
+                self.originals[cdr_id] = original
+
+    def add(self, doc, payload):
+        """Schedule a document which is ready to be pushed
+
+        Pass:
+          doc - Summary object for the document
+          payload - encoded CMS values for the document
+
+        Return:
+          sequence of (Summary, Payload) tuples which can be pushed now
+        """
+
+        original = self.originals.get(doc.id)
+        if original is None or original in self.done:
+            return [(doc, payload)]
+        self.waiting.setdefault(original, []).append((doc, payload))
+        return []
+
+    def drain(self):
+        """Release documents whose originals will not be pushed
+
+        This is a safety net for originals which never reached the
+        scheduler after selection. Documents which the `--compare`
+        option filters out are reported to `finished()` as soon as the
+        CMS copy is found to match.
+
+        Return:
+          sequence of (Summary, Payload) tuples which can be pushed now
+        """
+
+        released = []
+        for original in list(self.waiting):
+            released.extend(self.waiting.pop(original))
+        return released
+
+    def finished(self, cdr_id):
+        """Record that a document is no longer waiting to be pushed
+
+        This is also called when the push fails. The translations are
+        still attempted, and they fail in turn unless the CMS already
+        has a node for the English summary from an earlier job. With
+        `--compare`, it is called for each document the CMS already has,
+        since that document won't be pushed at all.
+
+        Pass:
+          cdr_id - integer for the document which was pushed
+
+        Return:
+          sequence of (Summary, Payload) tuples which can now be pushed
+        """
+
+        self.done.add(cdr_id)
+        return self.waiting.pop(cdr_id, [])
+
+
+class Publisher:
+    """Sweep pushed documents to the `published` state as the job goes
+
+    Rather than waiting for every push to finish, a background thread
+    asks the CMS to publish each batch (and to prune the older revisions
+    of its nodes) as soon as `batch_size` documents have been pushed,
+    while the pushes carry on. Documents are published in the order in
+    which their pushes finished, and a Spanish translation is not pushed
+    until its English summary has been (see `Scheduler`), so an English
+    summary is never published in a later batch than its translation.
+    The sweep for summary sections left without parent nodes still
+    waits until the end, when it can find them all at once.
+    """
+
+    def __init__(self, control):
+        """Start the thread which does the publishing
+
+        Required positional argument:
+          control - provides access to processing information
+        """
+
+        self.control = control
+        self.errors = {}
+        self.failure = None
+        self.sent = 0
+        self.queue = Queue()
+        self.thread = Thread(target=self.__run, name="publish", daemon=True)
+        self.thread.start()
+
+    def add(self, cdr_id, nid, langcode):
+        """Queue a document which has been pushed for publishing
+
+        Pass:
+          cdr_id - integer for the document's unique CDR ID
+          nid - integer for the Drupal node for the document
+          langcode - language code ('en' or 'es')
+        """
+
+        self.queue.put((cdr_id, nid, langcode))
+
+    def finish(self):
+        """Publish what is left, once all the pushes are done
+
+        Return:
+          possibly empty dictionary of error messages, indexed by the
+          CDR ID for documents which failed
+        """
+
+        self.stop()
+        if self.failure is not None:
+            raise self.failure
+        if self.sent:
+            self.control.client.drop_orphans()
+            args = self.sent - len(self.errors), self.sent
+            message = "%d of %d documents published"
+            self.control.logger.info(message, *args)
+        return self.errors
+
+    def stop(self):
+        """Publish whatever is still queued and wait for the thread
+
+        Called even when the job is failing, so the documents which did
+        get pushed are published, and the thread is never cut off in the
+        middle of saving the manifest when the process exits.
+        """
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def __run(self):
+        """Publish the queued documents in batches until told to stop"""
+
+        batch = []
+        try:
+            while True:
+                document = self.queue.get()
+                if document is None:
+                    break
+                batch.append(document)
+                if len(batch) >= self.control.client.batch_size:
+                    self.__flush(batch)
+                    batch = []
+            if batch:
+                self.__flush(batch)
+        except Exception as e:
+            self.control.logger.exception("publishing failed")
+            self.failure = e
+
+    def __flush(self, batch):
+        """Publish one batch of documents and prune their old revisions
+
+        Pass:
+          batch - sequence of (cdr_id, nid, langcode) tuples
+        """
+
+        client = self.control.client
+        self.errors.update(client.publish(batch, cleanup=False))
+        client.prune_revisions(sorted({doc[1] for doc in batch}))
+        self.sent += len(batch)
+
+
+class RenderCache:
+    """Values rendered for summaries by earlier runs
+
+    Each entry is stored under a hash of everything which goes into
+    rendering the summary: the source XML, the stylesheets (including
+    the shared templates), the media tier, and `VERSION`, which must be
+    bumped whenever a change to this script alters the values it
+    generates. Entries which are used are touched, so when the cache
+    grows past `MAX_SIZE` bytes the least recently used ones are dropped.
+    """
+
+    VERSION = 2
+    MAX_SIZE = 512 * 1024 * 1024
+    TEMPLATES = "cms-templates.xsl"
+
+    def __init__(self, control):
+        """Remember the caller and start the statistics from scratch
+
+        Required positional argument:
+          control - provides access to processing information
+        """
+
+        self.control = control
+        self.hits = self.misses = self.evictions = 0
+        self.keys = {}
+
+    @cached_property
+    def directory(self):
+        """Where the cached values live"""
+        path = self.control.CACHE / "render"
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    @cached_property
+    def enabled(self):
+        """False if the user wants everything rendered from scratch"""
+        return not self.control.opts.no_cache
+
+    @cached_property
+    def logger(self):
+        """Object for recording what we do"""
+        return self.control.logger
+
+    @cached_property
+    def salt(self):
+        """Hashes of rendering inputs shared by all summaries of a type"""
+
+        salt = {}
+        tier = self.control.opts.tier.lower()
+        for cls in CIS, DIS:
+            digest = sha256(f"{self.VERSION}:{tier}:".encode("utf-8"))
+            for name in cls.STYLESHEET, self.TEMPLATES:
+                digest.update(Path(name).read_bytes())
+            salt[cls.TYPE] = digest.digest()
+        return salt
+
+    @cached_property
+    def usage(self):
+        """Total number of bytes currently stored in the cache"""
+        return sum(p.stat().st_size for p in self.directory.glob("*/*.json"))
+
+    def get(self, doc):
+        """Find the cached values for a summary
+
+        Pass:
+          doc - Summary object whose values we want
+
+        Return:
+          `Payload` object if cached, otherwise None
+        """
+
+        if not self.enabled:
+            return None
+        digest = sha256(self.salt[doc.TYPE])
+        digest.update(doc.path.read_bytes())
+        key = self.keys[doc.id] = digest.hexdigest()
+        path = self.directory / key[:2] / f"{key}.json"
+        try:
+            body = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        utime(path)
+        self.hits += 1
+        self.logger.debug("CDR%d found in render cache", doc.id)
+        return Payload(body)
+
+    def put(self, doc, payload):
+        """Save newly rendered values for a summary
+
+        Pass:
+          doc - Summary object whose values were rendered
+          payload - encoded CMS values for the summary
+        """
+
+        path = self.target(doc)
+        if path is not None:
+            payload.save(path)
+            self.stored(len(payload.body))
+
+    def stored(self, size):
+        """Account for a new entry, trimming the cache if it is too big
+
+        Pass:
+          size - number of bytes in the new entry
+        """
+
+        self.usage += size
+        if self.usage > self.MAX_SIZE:
+            self.__evict()
+
+    def target(self, doc):
+        """Find where newly rendered values for a summary belong
+
+        Pass:
+          doc - Summary object which missed in `get()`
+
+        Return:
+          location for the new cache entry, or None if not caching
+        """
+
+        key = self.keys.pop(doc.id, None)
+        if key is None:
+            return None
+        path = self.directory / key[:2] / f"{key}.json"
+        path.parent.mkdir(exist_ok=True)
+        return path
+
+    def report(self):
+        """Log the cache statistics for the job"""
+
+        if self.enabled:
+            args = self.hits, self.misses, self.evictions
+            message = "render cache: %d hits, %d misses, %d evictions"
+            self.logger.info(message, *args)
+
+    def __evict(self):
+        """Drop the least recently used entries to make room for new ones"""
+
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        self.usage = sum(entry[1] for entry in entries)
+        target = self.MAX_SIZE * 9 // 10
+        for mtime, size, path in sorted(entries):
+            if self.usage <= target:
+                break
+            path.unlink(missing_ok=True)
+            self.usage -= size
+            self.evictions += 1
+        self.logger.info("render cache trimmed to %d bytes", self.usage)
+
+
+class Payload:
+    """CMS values for a summary, encoded exactly once
+
+    The values are serialized a single time as compact JSON with sorted
+    keys, in UTF-8, and those bytes are what gets cached, dumped, hashed
+    to detect changes, and sent to the CMS. When orjson is installed it
+    is used in place of the standard library, producing the same bytes
+    more quickly. A payload holds only the bytes, even when it was just
+    encoded from a dictionary, and the values are decoded again on the
+    rare occasions when they're needed, so no second copy is kept.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, body):
+        """Wrap an encoded set of values
+
+        Required positional argument:
+          body - UTF-8 bytes for the canonical JSON encoding
+        """
+
+        self.body = body
+
+    def __reduce__(self):
+        """Pickle only the encoded bytes"""
+        return Payload, (self.body,)
+
+    @classmethod
+    def from_values(cls, values):
+        """Encode a freshly generated dictionary of CMS values
+
+        Pass:
+          values - dictionary of field values keyed by field name
+
+        Return:
+          `Payload` object for the encoding
+        """
+
+        return cls(cls.encode(values))
+
+    @cached_property
+    def digest(self):
+        """Hex hash of the encoded values, used to detect changes"""
+        return sha256(self.body).hexdigest()
+
+    def save(self, path):
+        """Write the encoded values to a file, replacing it atomically
+
+        Pass:
+          path - location of the file
+        """
+
+        temp = path.with_suffix(".tmp")
+        temp.write_bytes(self.body)
+        temp.replace(path)
+
+    @property
+    def values(self):
+        """Dictionary of field values keyed by field name (not kept)"""
+        return self.decode(self.body)
+
+    def chunks(self, **fields):
+        """Generate the encoding piece by piece, without copying it
+
+        Used for chunked uploads, so a push never needs a second copy of
+        the whole encoding in memory. Same result as `with_fields()`.
+
+        Pass:
+          fields - additional field values keyed by field name
+
+        Yield:
+          bytes or memoryview slices of at most `CHUNK_SIZE` bytes
+        """
+
+        view = memoryview(self.body)
+        start = 0
+        if fields:
+            yield self.encode(fields)[:-1] + b","
+            start = 1
+        for offset in range(start, len(view), self.CHUNK_SIZE):
+            yield view[offset:offset+self.CHUNK_SIZE]
+
+    def with_fields(self, **fields):
+        """Encoding of the values with additional fields spliced in
+
+        Used for values which are only known at push time (such as the
+        node ID), so the rest of the payload is not encoded again. The
+        fields must not already be among the payload's values.
+
+        Pass:
+          fields - additional field values keyed by field name
+
+        Return:
+          UTF-8 bytes for the combined JSON object
+        """
+
+        if not fields:
+            return self.body
+        return self.encode(fields)[:-1] + b"," + self.body[1:]
+
+    @staticmethod
+    def decode(body):
+        """Parse encoded values
+
+        Pass:
+          body - UTF-8 bytes for a JSON object
+
+        Return:
+          dictionary of values
+        """
+
+        if orjson is not None:
+            return orjson.loads(body)
+        return json_loads(body)
+
+    @staticmethod
+    def encode(values):
+        """Produce the canonical encoding for a dictionary of values
+
+        Pass:
+          values - dictionary of field values keyed by field name
+
+        Return:
+          UTF-8 bytes for compact JSON with sorted keys
+        """
+
+        if orjson is not None:
+            return orjson.dumps(values, option=orjson.OPT_SORT_KEYS)
+        opts = dict(sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return json_dumps(values, **opts).encode("utf-8")
+
+
 class Summary:
     """Base class for both type of summaries."""
 
     DESCRIPTION_MAX = 600
-    chdir(Path(__file__).resolve().parent)
+    TRANSFORMS = {}
 
     def __init__(self, control, path):
         """Remember the caller and where to find the XML"""
@@ -192,10 +1496,38 @@ class Summary:
         b = other.langcode, other.TYPE, other.id
         return a < b
 
-    def dump(self):
-        """Save the summary's JSON locally"""
+    @property
+    def payload(self):
+        """Encoded CMS values for the summary (not cached; see `values`)"""
+        return Payload.from_values(self.values)
+
+    def dump(self, payload):
+        """Save the summary's JSON locally
+
+        Pass:
+          payload - encoded CMS values generated for the summary
+        """
+
         path = self.control.dump_dir / f"{self.id}.json"
-        path.write_text(json_dumps(self.values, indent=2), encoding="utf-8")
+        path.write_bytes(payload.body)
+
+    @property
+    def transform(self):
+        """Compiled XSLT for the summary type
+
+        Each stylesheet is only compiled the first time it is needed
+        (once in each process), so jobs which never render a summary of
+        one type don't pay for compiling its stylesheet.
+        """
+
+        if self.TYPE not in self.TRANSFORMS:
+            start = perf_counter()
+            transform = etree.XSLT(etree.parse(self.STYLESHEET))
+            self.TRANSFORMS[self.TYPE] = transform
+            elapsed = perf_counter() - start
+            args = self.STYLESHEET, elapsed
+            self.logger.debug("compiled %s in %.3f seconds", *args)
+        return self.TRANSFORMS[self.TYPE]
 
     @cached_property
     def id(self):
@@ -212,6 +1544,12 @@ class Summary:
         """Used to record what we do"""
         return self.control.logger
 
+    @cached_property
+    def translation_of(self):
+        """CDR ID for the original of a translated summary, else None"""
+        entry = self.control.catalog.entries.get(self.id) or {}
+        return entry.get("translation_of")
+
     @staticmethod
     def extract_id(arg):
         """
@@ -259,7 +1597,7 @@ class CIS(Summary):
     }
     BROWSER_TITLE_MAX = 100
     CTHP_CARD_TITLE_MAX = 100
-    TRANSFORM = etree.XSLT(etree.parse("cms-cis.xsl"))
+    STYLESHEET = "cms-cis.xsl"
 
     @property
     def values(self):
@@ -323,16 +1661,69 @@ class CIS(Summary):
                     error = "CDR{} missing title for section {} {}"
                     args = self.id, i + 1, types
                     raise Exception(error.format(*args))
-        target = "@@MEDIA-TIER@@"
+
+        # Pull together everything except the sections.
+        audience = self.get_text(meta.find("SummaryAudience"))
+        description = self.get_text(meta.find("SummaryDescription"))
+        if len(description) > self.DESCRIPTION_MAX:
+            self.logger.warning("Truncating description %r", description)
+            description = description[:self.DESCRIPTION_MAX]
+        if len(browser_title) > self.BROWSER_TITLE_MAX:
+            message = "Truncating browser title %r"
+            self.logger.warning(message, browser_title)
+            browser_title = browser_title[:self.BROWSER_TITLE_MAX]
+        if len(cthp_card_title) > self.CTHP_CARD_TITLE_MAX:
+            self.logger.warning("Truncating cthp title %r", cthp_card_title)
+            cthp_card_title = cthp_card_title[:self.CTHP_CARD_TITLE_MAX]
+        sections = []
+        values = {
+            "cdr_id": self.id,
+            "url": url,
+            "browser_title": browser_title,
+            "cthp_card_title": cthp_card_title,
+            "translation_of": translation_of,
+            "sections": sections,
+            "title": self.get_text(root.find("SummaryTitle")),
+            "description": description,
+            "summary_type": self.get_text(meta.find("SummaryType")),
+            "audience": audience.replace(" prof", " Prof"),
+            "language": self.langcode,
+            "posted_date": self.get_text(root.find("DateFirstPublished")),
+            "updated_date": self.get_text(root.find("DateLastModified")),
+            "type": "pdq_cancer_information_summary",
+            "suppress_otp": suppress_otp,
+            "svpc": svpc,
+            "intro_text": None,
+        }
+
+        # Transform the summary, letting go of the source document (any
+        # element we still hold would keep the whole tree alive) and then
+        # of each section as soon as it has been serialized.
         tier = self.control.opts.tier.lower()
-        replacement = f"-{tier}" if tier != "prod" else ""
-        transformed = self.TRANSFORM(root)
-        self.__consolidate_citation_references(transformed)
+        media_tier = f"-{tier}" if tier != "prod" else ""
+        media_tier = etree.XSLT.strparam(media_tier)
+        transformed = self.transform(root, mediaTier=media_tier)
+        root = meta = node = child = None
         xpath = 'body/div/article/div[@class="pdq-sections"]'
-        sections = []
-        intro_text = None
+        nodes = transformed.xpath(xpath)
+        transformed = None
+        nodes.reverse()
         i = 0
-        for node in transformed.xpath(xpath):
+        while nodes:
+            node = nodes.pop()
+
+            # One walk per section finds both citation links and headers.
+            # 2019-03-13 (per BP): don't strip "cit/" from citation links.
+            links = []
+            headers = []
+            for child in node.iter("a", "h3", "h4"):
+                if child.tag != "a":
+                    headers.append(child)
+                else:
+                    href = child.get("href")
+                    if href is not None and href.startswith("#cit/section"):
+                        links.append(child)
+            self.__consolidate_citation_references(links)
             h2 = node.find("h2")
             if h2 is None:
                 section_title = ""
@@ -341,15 +1732,11 @@ class CIS(Summary):
                 node.remove(h2)
             if intro_text_index != i and node.get("id") != self.ABOUT_THIS:
                 if not svpc:
-                    headers = list(node.iter("h3", "h4"))
                     if headers and "kpBox" not in headers[0].get("id", ""):
                         links = B.UL()
                         parent = nested_links = None
                         for header in headers:
-                            link = deepcopy(header)
-                            link.set("href", "#" + link.get("id"))
-                            del link.attrib["id"]
-                            link.tag = "a"
+                            link = self.__header_link(header)
                             if header.tag == "h3":
                                 parent = B.LI(link)
                                 nested_links = None
@@ -369,9 +1756,9 @@ class CIS(Summary):
                         nav.set("role", "navigation")
                         node.insert(0, nav)
             body = html.tostring(node).decode("utf-8")
-            body = body.replace(target, replacement)
+            node.getparent().remove(node)
             if intro_text_index == i:
-                intro_text = body
+                values["intro_text"] = body
             else:
                 section_id = node.get("id")
                 if section_id.startswith("_section"):
@@ -382,41 +1769,9 @@ class CIS(Summary):
                     "html": body,
                 })
             i += 1
+        return values
 
-        # Pull everything together.
-        audience = self.get_text(meta.find("SummaryAudience"))
-        description = self.get_text(meta.find("SummaryDescription"))
-        if len(description) > self.DESCRIPTION_MAX:
-            self.logger.warning("Truncating description %r", description)
-            description = description[:self.DESCRIPTION_MAX]
-        if len(browser_title) > self.BROWSER_TITLE_MAX:
-            message = "Truncating browser title %r"
-            self.logger.warning(message, browser_title)
-            browser_title = browser_title[:self.BROWSER_TITLE_MAX]
-        if len(cthp_card_title) > self.CTHP_CARD_TITLE_MAX:
-            self.logger.warning("Truncating cthp title %r", cthp_card_title)
-            cthp_card_title = cthp_card_title[:self.CTHP_CARD_TITLE_MAX]
-        return {
-            "cdr_id": self.id,
-            "url": url,
-            "browser_title": browser_title,
-            "cthp_card_title": cthp_card_title,
-            "translation_of": translation_of,
-            "sections": sections,
-            "title": self.get_text(root.find("SummaryTitle")),
-            "description": description,
-            "summary_type": self.get_text(meta.find("SummaryType")),
-            "audience": audience.replace(" prof", " Prof"),
-            "language": self.langcode,
-            "posted_date": self.get_text(root.find("DateFirstPublished")),
-            "updated_date": self.get_text(root.find("DateLastModified")),
-            "type": "pdq_cancer_information_summary",
-            "suppress_otp": suppress_otp,
-            "svpc": svpc,
-            "intro_text": intro_text,
-        }
-
-    def __consolidate_citation_references(self, root):
+    def __consolidate_citation_references(self, links):
         """
         Combine adjacent citation reference links
 
@@ -446,20 +1801,12 @@ class CIS(Summary):
         have "cit/" stripped from the linking URLs.
 
         Pass:
-          root - reference to parsed XML document for the PDQ summary
+          links - citation links for one section, in document order
 
         Return:
           None (parsed tree is altered as a side effect)
         """
 
-        # Collect all of the citation links, stripping "cit/" from the url.
-        # 2019-03-13 (per BP): don't strip "cit/".
-        links = []
-        for link in root.iter("a"):
-            href = link.get("href")
-            if href is not None and href.startswith("#cit/section"):
-                links.append(link)
-
         # Collect links which are only separated by optional whitespace.
         adjacent = []
         for link in links:
@@ -488,6 +1835,32 @@ class CIS(Summary):
         if adjacent:
             self.__rewrite_adjacent_citation_refs(adjacent)
 
+    @staticmethod
+    def __header_link(header):
+        """
+        Create an "In This Section" link for a section header
+
+        Only the header's children are copied; the header element itself
+        is not, so its ID never needs to be stripped from the copy.
+
+        Pass:
+          header - h3 or h4 element from the transformed summary
+
+        Return:
+          `a` element with the header's markup linking to the header
+        """
+
+        link = etree.Element("a")
+        for name, value in header.items():
+            if name != "id":
+                link.set(name, value)
+        link.set("href", "#" + header.get("id"))
+        link.text = header.text
+        for child in header:
+            link.append(deepcopy(child))
+        link.tail = header.tail
+        return link
+
     def __rewrite_adjacent_citation_refs(self, links):
         """
         Add punctuation to citation reference links and collapse ranges
@@ -559,7 +1932,7 @@ class DIS(Summary):
     """Drug Information Summary"""
 
     TYPE = "dis"
-    TRANSFORM = etree.XSLT(etree.parse("cms-dis.xsl"))
+    STYLESHEET = "cms-dis.xsl"
 
     @property
     def values(self):
@@ -603,7 +1976,7 @@ class DIS(Summary):
             "updated_date": self.get_text(root.find("DateLastModified")),
             "pron": pron,
             "audio_id": audio_id,
-            "body": html.tostring(self.TRANSFORM(root)).decode("utf-8"),
+            "body": html.tostring(self.transform(root)).decode("utf-8"),
             "type": "pdq_drug_information_summary",
         }
 
@@ -612,8 +1985,33 @@ class DrupalClient:
     """
     Client end of the PDQ RESTful APIs in the Drupal CMS
 
+    In order to avoid pushing documents which have not changed since
+    they were last sent to the CMS, we keep a manifest for each CMS
+    server, holding a hash of the values pushed for each document,
+    along with the node ID and a timestamp for the push. Entries are
+    only added to the manifest once the documents have been published
+    successfully. Because non-production servers are frequently
+    refreshed from other tiers, the `--force` option can be used to
+    bypass the manifest, and `--forget` discards it for a server.
+
+    Alternatively, the `--compare` option asks the CMS for its copy of
+    each document, and only pushes the documents which are missing or
+    which differ from what we generated. This is slower than relying
+    on the manifest, but it catches changes made by hand in the CMS.
+
+    The nodes for documents missing from the manifest (or for all the
+    documents, with `--force`) are looked up by a few threads at the
+    start of the job, ahead of the pushes. The rest are likely to be
+    unchanged, so they are only looked up if they are actually pushed.
+    A node ID recorded in the manifest is never sent to the CMS without
+    that check, because a refreshed server may have the document in a
+    different node, or none at all; when they differ, we log the
+    mismatch and drop the entry. The node returned for each push is
+    remembered for the rest of the job, so a Spanish translation pushed
+    after its English summary never has to ask the CMS where the
+    English summary went.
+
     Class constants:
-        NAX_RETRIES - number of times to try again for failures
         BATCH_SIZE - maximum number of documents we can set to `published`
                      in a single chunk
         PRUNE_BATCH_SIZE - maximum number of nodes to process at one time
@@ -622,9 +2020,13 @@ class DrupalClient:
                             request at a time
         URI_PATH - used for routing of PDQ RESTful API requests
         TYPES - names used for the types of PDQ documents we publish
+        MANIFEST - file in which we record what we have pushed
+        COMPARE_THREADS - how many CMS copies to fetch at once
+        POOL_SIZE - default for how many connections to keep open
+        PREFETCH_THREADS - how many node lookups to run at once
+        TIMEOUT - seconds to wait for a connection and for a response
     """
 
-    MAX_RETRIES = 5
     BATCH_SIZE = 25
     PRUNE_BATCH_SIZE = 10
     ORPHAN_BATCH_SIZE = 1000
@@ -633,6 +2035,14 @@ class DrupalClient:
         "Summary": ("pdq_cancer_information_summary", "cis"),
         "DrugInformationSummary": ("pdq_drug_information_summary", "dis"),
     }
+    MANIFEST = Control.CACHE / "manifest.json"
+    COMPARE_THREADS = 8
+    POOL_SIZE = 10
+    PREFETCH_THREADS = 4
+    TIMEOUT = 10, 300
+    BETWEEN_TAGS = re_compile(r">\s+<")
+    WHITESPACE = re_compile(r"\s+")
+    DATE = re_compile(r"^\d{4}-\d\d-\d\d\b")
 
     def __init__(self, control):
         """
@@ -641,6 +2051,21 @@ class DrupalClient:
         """
 
         self.control = control
+        self.lock = Lock()
+        self.lookups = {}
+        self.lookup_pool = None
+        self.nodes = {}
+        self.pending = {}
+        self.skipped = 0
+
+        # Shared by all of our threads, so built before any of them start.
+        maximum = control.concurrency
+        if control.opts.compare:
+            maximum += self.COMPARE_THREADS
+        else:
+            maximum += self.PREFETCH_THREADS
+        self.retries = RetryPolicy(self.logger)
+        self.throttle = Throttle(self.logger, maximum)
         self.logger.info("DrupalClient created for %s", self.base)
 
     @cached_property
@@ -665,55 +2090,289 @@ class DrupalClient:
         """Object for recording what we do"""
         return self.control.logger
 
+    @cached_property
+    def manifest(self):
+        """What we have successfully pushed to this CMS, by CDR ID"""
+
+        if not self.MANIFEST.exists():
+            return {}
+        manifests = json_loads(self.MANIFEST.read_text())
+        return manifests.get(self.base, {})
+
+    @cached_property
+    def pool_size(self):
+        """Most connections the session will keep open to the CMS"""
+
+        # Room for every request the throttle allows, plus publishing.
+        pool_size = max(self.POOL_SIZE, self.throttle.maximum + 1)
+        return self.control.opts.connections or pool_size
+
+    @cached_property
+    def requests(self):
+        """HTTP library, only loaded when we actually talk to the CMS"""
+
+        import requests
+        return requests
+
+    @cached_property
+    def session(self):
+        """Pooled HTTP connections to the CMS, shared by all our threads
+
+        Connections are kept alive and reused for later requests, so we
+        don't pay for a new TCP connection and TLS handshake on each one.
+        """
+
+        session = self.requests.Session()
+        adapter = self.requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
     @cached_property
     def types(self):
         """Mapping from Drupal class for content to API URL tail"""
         return dict(self.TYPES.values())
 
-    def push(self, values):
+    def cancel_lookups(self):
+        """Drop the prefetched lookups which haven't been started yet
+
+        Otherwise a job which fails early would wait for every one of
+        them to be sent before the process could exit.
+        """
+
+        if self.lookup_pool is not None:
+            self.lookup_pool.shutdown(wait=False, cancel_futures=True)
+
+    def changed(self, documents, scheduler):
+        """Filter out documents for which the CMS already has our values
+
+        The CMS copies are fetched by a bounded pool of threads, a few
+        documents ahead of the caller, and the documents which need to
+        be pushed are handed back in their original order. A document
+        which is filtered out is done as far as the scheduler is
+        concerned, so any translations held back for it are handed back
+        right away, rather than waiting for the end of the comparisons.
+
+        Pass:
+          documents - iterable sequence of (Summary, Payload) tuples
+          scheduler - holds translations back until their originals are
+                      done
+
+        Yield:
+          (Summary, Payload) tuples for documents which are missing
+          from the CMS or whose values differ from what it has
+        """
+
+        counts = dict(identical=0, changed=0, missing=0)
+        pending = deque()
+
+        def collect():
+            item, future = pending.popleft()
+            outcome = future.result()
+            counts[outcome] += 1
+            if outcome == "identical":
+                return scheduler.finished(item[0].id)
+            return [item]
+
+        with ThreadPoolExecutor(self.COMPARE_THREADS) as pool:
+            for item in documents:
+                future = pool.submit(self.compare, item[1].values)
+                pending.append((item, future))
+                if len(pending) >= self.COMPARE_THREADS * 2:
+                    yield from collect()
+            while pending:
+                yield from collect()
+        message = "compared with CMS: %d identical, %d changed, %d missing"
+        args = counts["identical"], counts["changed"], counts["missing"]
+        self.logger.info(message, *args)
+
+    def compare(self, values):
+        """Find out whether the CMS already has the values for a document
+
+        Pass:
+          values - dictionary of field values keyed by field name
+
+        Return:
+          "identical", "changed", or "missing"
+        """
+
+        cdr_id = values["cdr_id"]
+        try:
+            remote = self.fetch(values)
+        except Exception as e:
+            self.logger.warning("CDR%d: %s (will push)", cdr_id, e)
+            return "changed"
+        if remote is None:
+            self.logger.debug("CDR%d not found in the CMS", cdr_id)
+            return "missing"
+        local = self.normalize(values)
+        remote = self.normalize(remote)
+        for key in local:
+            if local[key] != remote.get(key):
+                self.logger.debug("CDR%d: %s differs from CMS", cdr_id, key)
+                return "changed"
+        return "identical"
+
+    def fetch(self, values):
+        """Get the CMS copy of a document's values
+
+        The PDQ API answers GET requests on the same per-type resources
+        to which we post the documents.
+
+        Pass:
+          values - dictionary of field values keyed by field name
+
+        Return:
+          dictionary of values stored by the CMS or None if not found
+        """
+
+        t = self.types[values["type"]]
+        cdr_id = values["cdr_id"]
+        url = f"{self.base}{self.URI_PATH}/{t}/{cdr_id}?_format=json"
+        self.logger.debug("URL for fetch(): %s", url)
+        # TODO: Get Acquia to fix their broken certificates.
+        response = self.send("get", url, auth=self.auth, verify=False)
+        if response.status_code == 404:
+            return None
+        if not response.ok:
+            code = response.status_code
+            reason = response.reason
+            raise Exception(f"fetch returned code {code}: {reason}")
+        return json_loads(response.text)
+
+    def forget(self):
+        """Discard the manifest of what we have pushed to this CMS"""
+
+        self.logger.info("%d manifest entries dropped", len(self.manifest))
+        self.manifest.clear()
+        self.__save_manifest()
+
+    def prefetch(self, docs):
+        """Start looking up the nodes for the documents we will push
+
+        The lookups run on threads of their own, in push order, so each
+        node ID is usually ready by the time its push needs it. Nodes
+        for documents recorded in the manifest are left for the pushes
+        to look up (unless the `--force` option was used), as most of
+        those documents won't need to be pushed. For a Spanish
+        translation, it is the node for the English summary we need.
+
+        Pass:
+          docs - sequence of Summary objects in the order of the pushes
+        """
+
+        force = self.control.opts.force
+        ids = []
+        for doc in docs:
+            cdr_id = doc.translation_of or doc.id
+            if cdr_id in self.lookups or cdr_id <= 0:
+                continue
+            if not force and str(cdr_id) in self.manifest:
+                continue
+            self.lookups[cdr_id] = None
+            ids.append(cdr_id)
+        if ids:
+            self.logger.info("looking up %d nodes in the CMS", len(ids))
+            opts = dict(thread_name_prefix="lookup")
+            pool = ThreadPoolExecutor(self.PREFETCH_THREADS, **opts)
+            for cdr_id in ids:
+                self.lookups[cdr_id] = pool.submit(self.lookup, cdr_id)
+            self.lookup_pool = pool
+
+    def push(self, doc, payload):
         """Send a PDQ document to the Drupal CMS
 
         The document will be stored in the `draft` state, and must be
-        released to the `published` state at the end of the job in batch
-        with the other PDQ documents published by the job (see the
-        `publish()` method).
+        released to the `published` state in a batch with other PDQ
+        documents published by the job (see the `publish()` method and
+        the `Publisher` class).
+
+        If the values are identical to what we last pushed to this CMS
+        for the document, the push is skipped (unless `--force` is used).
+        The payload's encoding is sent as is, with the node ID spliced in.
+        With `--stream` it is sent using chunked transfer encoding, as
+        slices of the payload, instead of as a single body. What we
+        need to know about the document comes from the `Summary` object,
+        so the payload itself is never decoded.
 
         Pass:
-          values - dictionary of field values keyed by field name
+          doc - `Summary` object for the document
+          payload - encoded field values for the document
 
         Return:
           integer for the ID of the node in which the document is stored
+          or None if the push was skipped
         """
 
+        # Don't send the document if the CMS already has these values.
+        cdr_id = doc.id
+        digest = payload.digest
+        opts = self.control.opts
+        stream = opts.stream
+        if not opts.force and not opts.compare:
+            entry = self.manifest.get(str(cdr_id))
+            if entry and entry["hash"] == digest:
+                args = cdr_id, entry["pushed"]
+                self.logger.debug("CDR%d unchanged since %s", *args)
+                with self.lock:
+                    self.skipped += 1
+                return None
+
         # Make sure we use the existing node if already in the CMS.
-        self.__check_nid(values)
+        expected = self.__check_nid(doc)
 
         # Different types use different API URLs.
-        t = values["type"]
-        url = f"{self.base}{self.URI_PATH}/{self.types[t]}?_format=json"
+        url = f"{self.base}{self.URI_PATH}/{doc.TYPE}?_format=json"
         self.logger.debug("URL for push(): %s", url)
 
         # Send the values to the CMS and check for success.
         # TODO: Get Acquia to fix their broken certificates.
-        opts = {"json": values, "auth": self.auth, "verify": False}
-        tries = self.MAX_RETRIES
-        while tries > 0:
-            response = post(url, **opts)
-            if response.ok:
-                break
-            tries -= 1
-            if tries <= 0:
-                self.logger.error("%r failed: %s", url, response.reason)
-                raise Exception(response.reason)
-            sleep(1)
-            args = values["cdr_id"], response.reason
-            self.logger.warning("%s: %s (trying again)", *args)
+        # A request which creates a node isn't sent again blindly if the
+        # connection fails, as the node may have been created anyway.
+        headers = {"Content-Type": "application/json"}
+        opts = dict(headers=headers, auth=self.auth, verify=False)
+
+        def post(nid):
+            if stream:
+                opts["data"] = lambda: payload.chunks(nid=nid)
+            else:
+                opts["data"] = payload.with_fields(nid=nid)
+            return self.send("post", url, resend=nid is not None, **opts)
+
+        try:
+            response = post(expected)
+        except self.requests.RequestException as e:
+            if expected is not None:
+                raise
+            message = "CDR%d: %s; checking for a new node before retrying"
+            self.logger.warning(message, cdr_id, e)
+            expected = self.lookup(cdr_id)
+            response = post(expected)
+        if not response.ok:
+            self.logger.error("%r failed: %s", url, response.reason)
+            raise Exception(response.reason)
 
         # Give the caller the node ID where the document was stored.
         parsed = json_loads(response.text)
         nid = int(parsed["nid"])
-        args = values["cdr_id"], self.base, nid
+        args = cdr_id, self.base, nid
         self.logger.debug("Pushed CDR%d to %s as node %d", *args)
+        if expected is not None and nid != expected:
+            args = cdr_id, nid, expected
+            self.logger.warning("CDR%d stored in node %d, not %d", *args)
+            original = doc.translation_of or cdr_id
+            with self.lock:
+                self.manifest.pop(str(original), None)
+        with self.lock:
+            self.nodes[cdr_id] = nid
+            self.pending[cdr_id] = dict(
+                hash=digest,
+                nid=nid,
+                pushed=datetime.now().isoformat(timespec="seconds"),
+            )
         return nid
 
     def publish(self, documents, **opts):
@@ -743,6 +2402,9 @@ class DrupalClient:
                     as summary section entities which have no parent
                     summary nodes
 
+        Documents which are successfully published are added to the
+        manifest of what this CMS has.
+
         Return:
           possibly empty dictionary of error messages, indexed by the
           CDR ID for documents which failed
@@ -752,38 +2414,37 @@ class DrupalClient:
         self.logger.info("Marking %d documents published", len(documents))
         self.logger.debug("URL for publish(): %s", url)
         offset = 0
-        lookup = {(doc[1:], doc[0]) for doc in documents}
+        lookup = {tuple(doc[1:]): doc[0] for doc in documents}
         errors = {}
         while offset < len(documents):
             end = offset + self.batch_size
-            chunk = [doc[1:] for doc in documents[offset:end]]
+            chunk = [tuple(doc[1:]) for doc in documents[offset:end]]
             self.logger.debug("Marking %d docs as published", len(chunk))
             self.logger.debug("Docs: %r", chunk)
             offset = end
             # TODO: Get Acquia to fix their broken certificates.
-            opts = {"json": chunk, "auth": self.auth, "verify": False}
-            tries = self.MAX_RETRIES
-            while tries > 0:
-                response = post(url, **opts)
-                if not response.ok:
-                    tries -= 1
-                    if tries <= 0:
-                        for key in chunk:
-                            cdr_id = lookup[key]
-                            errors[cdr_id] = response.reason
-                            args = cdr_id, response.reason
-                            self.logger.error("CDR%d: %s", *args)
-                    else:
-                        sleep(1)
-                        msg = "publish(): %s (trying again)"
-                        self.logger.warning(msg, response.reason)
-                else:
-                    for nid, lang, err in json_loads(response.text)["errors"]:
-                        key = nid, lang
-                        cdr_id = lookup[(nid, lang)]
-                        errors[cdr_id] = err
-                        self.logger.error("CDR%d: %s", cdr_id, err)
-                    break
+            # Marking the same nodes published again is harmless.
+            args = {"json": chunk, "auth": self.auth, "verify": False}
+            response = self.send("post", url, resend=True, **args)
+            if not response.ok:
+                for key in chunk:
+                    cdr_id = lookup[key]
+                    errors[cdr_id] = response.reason
+                    args = cdr_id, response.reason
+                    self.logger.error("CDR%d: %s", *args)
+            else:
+                for nid, lang, err in json_loads(response.text)["errors"]:
+                    cdr_id = lookup[(nid, lang)]
+                    errors[cdr_id] = err
+                    self.logger.error("CDR%d: %s", cdr_id, err)
+        with self.lock:
+            for cdr_id, nid, langcode in documents:
+                entry = self.pending.pop(cdr_id, None)
+                if cdr_id in errors:
+                    self.manifest.pop(str(cdr_id), None)
+                elif entry:
+                    self.manifest[str(cdr_id)] = entry
+            self.__save_manifest()
         if opts.get("cleanup", True):
             nodes = sorted({doc[1] for doc in documents})
             self.prune_revisions(nodes)
@@ -804,7 +2465,7 @@ class DrupalClient:
         url = f"{self.base}{self.URI_PATH}/{cdr_id}?_format=json"
         self.logger.debug("URL for get_nid(): %s", url)
         # TODO: Get Acquia to fix their broken certificates.
-        response = get(url, auth=self.auth, verify=False)
+        response = self.send("get", url, auth=self.auth, verify=False)
         if response.ok:
             parsed = json_loads(response.text)
             if not parsed:
@@ -834,21 +2495,13 @@ class DrupalClient:
             offset += self.PRUNE_BATCH_SIZE
             data = {"nodes": node_ids, "keep": 3}
             opts = {"json": data, "auth": self.auth, "verify": False}
-            tries = self.MAX_RETRIES
-            while tries > 0:
-                tries -= 1
-                response = patch(url, **opts)
-                if response.ok:
-                    message = "dropped revisions %s for node %s"
-                    for nid, vids in json_loads(response.text):
-                        self.logger.debug(message, vids, nid)
-                    break
-                if tries:
-                    message = "prune_revisions(): %s (trying again)"
-                    self.logger.warning(message, response.reason)
-                    sleep(1)
-                else:
-                    self.logger.error("prune_revisions: %s", response.reason)
+            response = self.send("patch", url, **opts)
+            if response.ok:
+                message = "dropped revisions %s for node %s"
+                for nid, vids in json_loads(response.text):
+                    self.logger.debug(message, vids, nid)
+            else:
+                self.logger.error("prune_revisions: %s", response.reason)
 
     def drop_orphans(self):
         """Ask the CMS to remove summary sections without parent CIS nodes """
@@ -860,7 +2513,7 @@ class DrupalClient:
         opts["verify"] = False
         message = "dropped revisions %s for summary section %s"
         while True:
-            response = patch(url, **opts)
+            response = self.send("patch", url, **opts)
             if response.ok:
                 dropped = json_loads(response.text)
                 if not dropped:
@@ -871,32 +2524,540 @@ class DrupalClient:
                 self.logger.error("drop_orphans(): %s", response.reason)
                 break
 
-    def __check_nid(self, values):
-        """Insert node ID for document already in the Drupal CMS
+    def report(self):
+        """Log what it took to get our requests through to the CMS"""
+
+        self.retries.report()
+        args = self.throttle.limit, self.throttle.maximum
+        self.logger.info("CMS request limit finished at %d of %d", *args)
+
+    def send(self, method, url, **opts):
+        """Make an HTTP request to the CMS, trying again if appropriate
+
+        Each attempt waits its turn under the `throttle`, and whether
+        (and when) to try again is up to the `retries` policy. Unless
+        the caller says otherwise, an attempt gives up (and counts as
+        a failure) after `TIMEOUT` seconds without a connection or a
+        response, so a stalled connection can't hold up the job.
+
+        Pass:
+          method - "get", "post", "patch", etc.
+          url - address for the request
+          opts - keyword arguments for `requests`; `data` can be a
+                 function returning the body, for bodies (such as
+                 generators) which can only be sent once; `resend`
+                 says whether the request is safe to send again after
+                 a failure which leaves us not knowing whether the CMS
+                 got it (the default is True, except for POST requests)
+
+        Return:
+          `requests.Response` object for the last attempt
+
+        Raise:
+          exception from `requests` if no response could be had, or
+          if the circuit breaker has stopped all requests to the CMS
+        """
+
+        data = opts.get("data")
+        resend = opts.pop("resend", method.lower() != "post")
+        opts.setdefault("timeout", self.TIMEOUT)
+        path = re_sub(r"/\d+", "/N", urlparse(url).path)
+        kind = f"{method.upper()} {path}"
+        attempt = 0
+        while True:
+            self.retries.check()
+            if callable(data):
+                opts["data"] = data()
+            started = self.throttle.acquire()
+            response = error = None
+            try:
+                response = self.session.request(method, url, **opts)
+            except self.requests.RequestException as e:
+                error = e
+            finally:
+                healthy = response is not None
+                if healthy:
+                    code = response.status_code
+                    healthy = code < 500 and code != 429
+                self.throttle.release(started, healthy, kind)
+            attempt += 1
+            if error is not None and not resend:
+                args = attempt, response, error, self.__unsent(error)
+                delay = self.retries.delay(*args)
+            else:
+                delay = self.retries.delay(attempt, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            reason = error or f"{response.status_code} {response.reason}"
+            args = method.upper(), url, reason, delay
+            message = "%s %s: %s (trying again in %.1f seconds)"
+            self.logger.warning(message, *args)
+            sleep(delay)
+
+    def warm_up(self, connections=1):
+        """Open connections to the CMS in the background
+
+        The TCP and TLS handshakes then overlap with the rendering of the
+        first documents instead of holding up the first requests.
+
+        Pass:
+          connections - how many connections to open (at most `pool_size`)
+        """
+
+        def connect():
+            try:
+                # TODO: Get Acquia to fix their broken certificates.
+                opts = dict(auth=self.auth, timeout=self.TIMEOUT)
+                session.head(url, verify=False, **opts)
+            except Exception as e:
+                self.logger.warning("connection warm-up failed: %s", e)
+
+        url = f"{self.base}{self.URI_PATH}"
+        session = self.session  # created here, not racing in the threads
+        connections = min(connections, self.pool_size)
+        self.logger.debug("opening %d connections to %s", connections, url)
+        for i in range(connections):
+            Thread(target=connect, name=f"warm-up-{i}", daemon=True).start()
+
+    @classmethod
+    def normalize(cls, value):
+        """Prepare values for comparison with the CMS copy
+
+        The CMS may reformat what we send, so we ignore differences in
+        whitespace (including whitespace between HTML tags), treat
+        empty strings as missing values, drop the time portion from
+        dates, compare numbers as strings, and ignore node IDs.
+
+        Pass:
+          value - field value (possibly a dictionary or a list)
+
+        Return:
+          normalized version of the value
+        """
+
+        if isinstance(value, dict):
+            normalized = {}
+            for key, nested in value.items():
+                if key != "nid":
+                    normalized[key] = cls.normalize(nested)
+            return normalized
+        if isinstance(value, list):
+            return [cls.normalize(nested) for nested in value]
+        if isinstance(value, int):
+            return str(value)
+        if isinstance(value, str):
+            value = cls.BETWEEN_TAGS.sub("><", value)
+            value = cls.WHITESPACE.sub(" ", value).strip()
+            if cls.DATE.match(value):
+                return value[:10]
+            return value or None
+        return value
+
+    def __save_manifest(self):
+        """Record what this CMS has, preserving manifests for other servers"""
+
+        manifests = {}
+        if self.MANIFEST.exists():
+            manifests = json_loads(self.MANIFEST.read_text())
+        manifests[self.base] = self.manifest
+        self.MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.MANIFEST.with_suffix(".tmp")
+        temp.write_text(json_dumps(manifests, indent=2))
+        temp.replace(self.MANIFEST)
+
+    def __check_nid(self, doc):
+        """Find node ID for document already in the Drupal CMS
 
         Node must already exist when storing the Spanish translation
         of the summary (business rule confirmed by Bryan Pizillo).
 
         Pass:
-          values - dictionary of values for the document being stored
-                   (we save the node ID here if appropriate as a side
-                   effect)
+          doc - `Summary` object for the document being stored
+
+        Return:
+          integer for the existing node or None for a new document
         """
 
-        cdr_id = int(values["cdr_id"])
-        if cdr_id > 0 and not values.get("nid"):
-            translation_of = values.get("translation_of")
+        cdr_id = doc.id
+        if cdr_id > 0:
+            translation_of = doc.translation_of
             if translation_of:
-                nid = self.lookup(translation_of)
+
+                # Nodes pushed by this job are known without asking, but
+                # the English summary may have been pushed by some other
+                # job since the lookup was prefetched, so check a miss.
+                nid = self.__node(translation_of)
+                if not nid:
+                    nid = self.lookup(translation_of)
                 if not nid:
                     msg = f"CDR{cdr_id}: English summary must be saved first"
                     self.logger.error(msg)
                     raise Exception(msg)
             else:
-                nid = self.lookup(values["cdr_id"])
-            values["nid"] = nid
-        if "nid" not in values:
-            values["nid"] = None
+                nid = self.__node(cdr_id)
+            return nid
+        return None
+
+    def __node(self, cdr_id):
+        """Find the node for a document, as cheaply as possible
+
+        A node we pushed to during this job is used as is. Otherwise we
+        ask the CMS (or use the answer to a prefetched lookup), and check
+        what the manifest recorded against the answer.
+
+        Pass:
+          cdr_id - integer for the PDQ document
+
+        Return:
+          integer for the Drupal node, or None if the CMS has none
+        """
+
+        with self.lock:
+            nid = self.nodes.get(cdr_id)
+        if nid:
+            return nid
+        future = self.lookups.get(cdr_id)
+        if future is not None:
+            nid = future.result()
+        else:
+            nid = self.lookup(cdr_id)
+        entry = self.manifest.get(str(cdr_id))
+        if entry and entry.get("nid") != nid:
+            args = cdr_id, nid, entry.get("nid")
+            self.logger.warning("CDR%d is node %s, not %s as recorded", *args)
+            with self.lock:
+                self.manifest.pop(str(cdr_id), None)
+        return nid
+
+    def __unsent(self, error):
+        """True if a failed request can't have reached the CMS
+
+        Pass:
+          error - exception raised by `requests`
+
+        Return:
+          True for failures to connect, False for anything which could
+          have happened after the request was sent
+        """
+
+        if isinstance(error, self.requests.ConnectTimeout):
+            return True
+        if isinstance(error, self.requests.ConnectionError) and error.args:
+            from urllib3.exceptions import NewConnectionError
+            reason = getattr(error.args[0], "reason", None)
+            return isinstance(reason, NewConnectionError)
+        return False
+
+
+class Throttle:
+    """Adaptive limit on how many requests we have in flight to the CMS
+
+    The limit is adjusted AIMD-style, as TCP does for congestion. It
+    grows by one each time a full limit's worth of requests comes back
+    healthy, up to `maximum`, and is halved when the CMS answers with
+    a server error or a 429, when a request fails outright (timeouts,
+    dropped connections), or when the 95th percentile latency climbs
+    past `LATENCY_FACTOR` times its baseline. Latencies are tracked
+    separately for each kind of request, as a node lookup and the push
+    of a large summary take very different times even when the CMS is
+    perfectly healthy. Each baseline starts from the best 95th
+    percentile seen and drifts toward the current one by a fraction
+    (`BASELINE_DECAY`) at a time, so slow steady changes are accepted
+    and only a sharp rise counts. Only one cut is made for the requests
+    which were already in flight when trouble started. If `PAUSE_AFTER`
+    requests fail in a row while the limit is already down to one, the
+    CMS is clearly saturated, and no new requests are started for
+    `PAUSE` seconds.
+    """
+
+    START = 2
+    SAMPLES = 50
+    LATENCY_FACTOR = 2.0
+    BASELINE_DECAY = 0.05
+    PAUSE_AFTER = 5
+    PAUSE = 30
+
+    def __init__(self, logger, maximum):
+        """Start out cautiously
+
+        Required positional arguments:
+          logger - for recording changes to the limit
+          maximum - the limit will never grow past this
+        """
+
+        self.logger = logger
+        self.maximum = maximum
+        self.limit = min(self.START, maximum)
+        self.in_flight = self.successes = self.failures = 0
+        self.latencies = {}
+        self.baselines = {}
+        self.cut = perf_counter()
+        self.paused_until = 0
+        self.condition = Condition()
+
+    def acquire(self):
+        """Wait until a request can be started
+
+        Return:
+          start time for the request, to be passed to `release()`
+        """
+
+        with self.condition:
+            while True:
+                pause = self.paused_until - perf_counter()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+            return perf_counter()
+
+    def release(self, started, healthy, kind=None):
+        """Record how a request turned out and adjust the limit
+
+        Pass:
+          started - value returned by `acquire()` for the request
+          healthy - False if the CMS failed or refused the request
+          kind - key for the requests whose latencies are comparable
+        """
+
+        now = perf_counter()
+        with self.condition:
+            self.in_flight -= 1
+            if not healthy:
+                self.failures += 1
+                self.__cut(started, "errors")
+                if self.failures >= self.PAUSE_AFTER and self.limit == 1:
+                    self.failures = 0
+                    self.paused_until = now + self.PAUSE
+                    message = "CMS saturated; pausing requests for %d seconds"
+                    self.logger.warning(message, self.PAUSE)
+            else:
+                self.failures = 0
+                latencies = self.latencies.get(kind)
+                if latencies is None:
+                    latencies = deque(maxlen=self.SAMPLES)
+                    self.latencies[kind] = latencies
+                latencies.append(now - started)
+                if self.__slow(kind):
+                    self.__cut(started, "latency rising")
+                elif self.limit < self.maximum:
+                    self.successes += 1
+                    if self.successes >= self.limit:
+                        self.successes = 0
+                        self.limit += 1
+                        self.logger.debug("CMS limit raised to %d", self.limit)
+            self.condition.notify_all()
+
+    def __cut(self, started, reason):
+        """Halve the limit, unless that was done after `started`"""
+
+        if started >= self.cut:
+            self.cut = perf_counter()
+            self.successes = 0
+            for latencies in self.latencies.values():
+                latencies.clear()
+            if self.limit > 1:
+                self.limit //= 2
+                self.logger.info("CMS %s: limit cut to %d", reason, self.limit)
+
+    def __slow(self, kind):
+        """True if recent latency for `kind` is well above its baseline"""
+
+        latencies = self.latencies[kind]
+        if len(latencies) < self.SAMPLES // 2:
+            return False
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95)]
+        baseline = self.baselines.get(kind)
+        if baseline is None or p95 < baseline:
+            self.baselines[kind] = p95
+            return False
+        self.baselines[kind] += (p95 - baseline) * self.BASELINE_DECAY
+        return p95 > baseline * self.LATENCY_FACTOR
+
+
+class RetryPolicy:
+    """Decide whether, and when, to try a failed CMS request again
+
+    Only failures which might go away are retried: the statuses in
+    `RETRYABLE` and requests which get no response at all (timeouts,
+    dropped connections). Anything else, such as a 400 or a 404, is
+    handed straight back, as trying again can't help. Waits grow
+    exponentially from `BASE_DELAY` up to `MAX_DELAY` seconds, with
+    random jitter so that threads don't retry in lockstep, and the
+    CMS's `Retry-After` header is honored when present. A request which
+    isn't safe to repeat (one creating a node, for example) is only sent
+    again if it clearly never reached the CMS. A request is tried at
+    most `MAX_TRIES` times, and the whole job gets `BUDGET` retries.
+    After `BREAKER_THRESHOLD` failures in a row, the circuit breaker
+    opens and all requests fail immediately; once `BREAKER_COOLDOWN`
+    seconds have passed, requests are let through again, and the first
+    failure among them opens the breaker again.
+    """
+
+    RETRYABLE = {408, 429, 500, 502, 503, 504}
+    MAX_TRIES = 5
+    BASE_DELAY = 1
+    MAX_DELAY = 60
+    BUDGET = 500
+    BREAKER_THRESHOLD = 10
+    BREAKER_COOLDOWN = 60
+
+    def __init__(self, logger):
+        """Start the job with a full budget and the breaker closed
+
+        Required positional argument:
+          logger - for recording what happens
+        """
+
+        self.logger = logger
+        self.lock = Lock()
+        self.budget = self.BUDGET
+        self.failures = 0
+        self.open_until = 0
+        self.counts = Counter()
+        self.reasons = Counter()
+
+    def check(self):
+        """Refuse to start a request while the circuit breaker is open"""
+
+        if perf_counter() < self.open_until:
+            with self.lock:
+                self.counts["refused"] += 1
+            raise Exception("CMS circuit breaker is open")
+
+    def delay(self, attempt, response, error, resend=True):
+        """Find out how long to wait before trying a request again
+
+        Pass:
+          attempt - number of times the request has been tried
+          response - what the CMS sent back, if anything
+          error - exception raised if there was no response
+          resend - False if the request must not be sent again, as
+                   the CMS might have acted on it
+
+        Return:
+          number of seconds to wait, or None if the request should not
+          be tried again
+        """
+
+        if response is not None:
+            if response.status_code not in self.RETRYABLE:
+                with self.lock:
+                    self.failures = 0
+                    if not response.ok and response.status_code != 404:
+                        self.counts["not retryable"] += 1
+                return None
+            reason = str(response.status_code)
+        else:
+            reason = type(error).__name__
+        with self.lock:
+            self.reasons[reason] += 1
+            self.failures += 1
+            if self.failures >= self.BREAKER_THRESHOLD:
+                if perf_counter() >= self.open_until:
+                    self.open_until = perf_counter() + self.BREAKER_COOLDOWN
+                    self.counts["breaker opened"] += 1
+                    args = self.failures, self.BREAKER_COOLDOWN
+                    message = "%d CMS failures in a row; stopping for %d s"
+                    self.logger.error(message, *args)
+                self.counts["gave up"] += 1
+                return None
+            if not resend:
+                self.counts["not resent"] += 1
+                return None
+            if attempt >= self.MAX_TRIES:
+                self.counts["gave up"] += 1
+                return None
+            if self.budget <= 0:
+                if not self.counts["out of budget"]:
+                    self.logger.error("CMS retry budget used up")
+                self.counts["out of budget"] += 1
+                return None
+            self.budget -= 1
+            self.counts["retries"] += 1
+        limit = min(self.MAX_DELAY, self.BASE_DELAY * 2 ** (attempt - 1))
+        delay = limit / 2 + uniform(0, limit / 2)
+        if response is not None:
+            retry_after = self.retry_after(response)
+            if retry_after is not None:
+                delay = min(self.MAX_DELAY, retry_after)
+        return delay
+
+    def report(self):
+        """Log the retry statistics for the job"""
+
+        reasons = sorted(self.reasons.items())
+        reasons = ", ".join(f"{count} {reason}" for reason, count in reasons)
+        args = self.counts["retries"], reasons or "none"
+        self.logger.info("CMS retries: %d (failures: %s)", *args)
+        names = "not retryable", "not resent", "gave up", "out of budget"
+        for name in names:
+            if self.counts[name]:
+                message = "CMS requests %s: %d"
+                self.logger.info(message, name, self.counts[name])
+        if self.counts["breaker opened"]:
+            args = self.counts["breaker opened"], self.counts["refused"]
+            message = "CMS circuit breaker opened %d times (%d refused)"
+            self.logger.info(message, *args)
+
+    @staticmethod
+    def retry_after(response):
+        """Number of seconds the CMS asked us to wait, if it did"""
+
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+
+def start_renderer(opts):
+    """Prepare a worker process for rendering summaries
+
+    Each worker gets its own lightweight `Control` object, carrying the
+    options parsed by the parent process.
+
+    Pass:
+      opts - processing options from the parent's command line
+    """
+
+    global renderer
+    renderer = Control()
+    renderer.opts = opts
+
+
+def render_summary(cls, path, target):
+    """Generate the CMS values for a summary in a worker process
+
+    The encoded values are written to a file rather than returned, so
+    the megabytes for a large summary don't have to be pickled and
+    piped back to the parent process.
+
+    Pass:
+      cls - `CIS` or `DIS`
+      path - location of the summary document's XML
+      target - where to write the encoded values
+
+    Return:
+      tuple of target path, number of bytes written, and content hash
+    """
+
+    payload = cls(renderer, path).payload
+    payload.save(target)
+    return target, len(payload.body), payload.digest
 
 
 if __name__ == "__main__":